@@ -0,0 +1,200 @@
+""" Virtual dataset spanning a whole archive of flash-sorted LMA HDF5 files, such as
+    a day's worth of 10-minute LYLOUT_*.dat.flash.h5 files.
+
+"""
+from __future__ import absolute_import, print_function
+
+import glob
+import os
+from collections import OrderedDict
+
+import numpy as np
+import tables
+from numpy.lib.recfunctions import append_fields
+
+from stormdrain.pipeline import coroutine
+from stormdrain.pubsub import get_exchange
+
+from .hdf5_lma import TimeChunkIndex, events_table_path, hdf5_lock, write_column
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+def archive_files(paths):
+    """ Sorted list of HDF5 files given by paths, which may be a directory,
+        a glob pattern, or a sequence of file names.
+    """
+    if isinstance(paths, string_types):
+        if os.path.isdir(paths):
+            paths = os.path.join(paths, '*.h5')
+        return sorted(glob.glob(paths))
+    return sorted(paths)
+
+
+class HDF5ArchiveDataset(object):
+    """ Pipeline source for the events in many LMA HDF5 files, read lazily like
+        HDF5LazyDataset.
+
+        When the dataset is created, each file is scanned once for its number of
+        rows and its time range, which are kept in catalog. (The scan builds each
+        file's TimeChunkIndex sidecar, so later scans are fast.) On each reflow
+        only the files that overlap the time range of bounds are read, and at most
+        max_open files are kept open, least recently used being closed first.
+
+        Events from all files are numbered with a global row index in index_name,
+        the row number within the file plus the number of rows in all files
+        before it in the catalog. update() uses it to write changes to the right
+        row of the right file.
+
+        As with HDF5Dataset, files are opened read-only, and only the files
+        written by update() are reopened with mode, since HDF5 rewrites files
+        opened for writing when they are closed.
+
+        Flash tables are not combined, since flash ids are only unique within each
+        file, so flash_table is None.
+    """
+    catalog_dtype = [('path', object), ('table_path', object), ('nrows', 'i8'),
+                     ('row_offset', 'i8'), ('t_min', 'f8'), ('t_max', 'f8')]
+
+    def __init__(self, paths, target=None, mode='a', bounds=None, time_name='time',
+                 index_name='hdf_row_idx', max_open=8, chunk_rows=65536):
+        self.target = target
+        self.version = 0
+        self.mode = mode
+        self.bounds = bounds
+        self.time_name = time_name
+        self.index_name = index_name
+        self.max_open = max_open
+        self.chunk_rows = chunk_rows
+        self.flash_table = None
+        self.data = None
+        self._open = OrderedDict()
+        files = archive_files(paths)
+        if len(files) == 0:
+            raise IOError("No HDF5 files found in {0}".format(paths))
+        self.catalog = self.scan(files)
+
+        get_exchange('SD_reflow_start').attach(self)
+
+    def _sidecar(self, path, table_path):
+        return '{0}{1}.tindex.npz'.format(path, table_path.replace('/', '_'))
+
+    def scan(self, files):
+        """ Build the catalog for files, in order of start time """
+        catalog = np.zeros(len(files), dtype=self.catalog_dtype)
+        for i, path in enumerate(files):
+            with hdf5_lock:
+                h5file = tables.open_file(path, mode='r')
+                try:
+                    table_path = events_table_path(h5file)
+                    table = h5file.get_node(table_path)
+                    index = TimeChunkIndex(table, time_name=self.time_name, chunk_rows=self.chunk_rows,
+                                           sidecar=self._sidecar(path, table_path))
+                    catalog[i] = (path, table_path, table.nrows, 0,
+                                  index.mins.min() if table.nrows > 0 else np.inf,
+                                  index.maxs.max() if table.nrows > 0 else -np.inf)
+                finally:
+                    h5file.close()
+        catalog = catalog[np.argsort(catalog['t_min'], kind='mergesort')]
+        catalog['row_offset'][1:] = np.cumsum(catalog['nrows'])[:-1]
+        return catalog
+
+    def _table(self, i, writable=False):
+        """ Table and time index for file i of the catalog, opening it if needed.
+            Files are opened read-only, and reopened with mode only if writable.
+        """
+        path = self.catalog['path'][i]
+        table_path = self.catalog['table_path'][i]
+        with hdf5_lock:
+            if path in self._open:
+                entry = self._open.pop(path)
+                h5file, table, index = entry
+                if writable and (h5file.mode == 'r') and (self.mode != 'r'):
+                    h5file.close()
+                    h5file = tables.open_file(path, mode=self.mode)
+                    table = h5file.get_node(table_path)
+                    index.table = table
+                    entry = (h5file, table, index)
+            else:
+                while len(self._open) >= self.max_open:
+                    old_path, (old_file, old_table, old_index) = self._open.popitem(last=False)
+                    old_file.close()
+                h5file = tables.open_file(path, mode=self.mode if writable else 'r')
+                table = h5file.get_node(table_path)
+                index = TimeChunkIndex(table, time_name=self.time_name, chunk_rows=self.chunk_rows,
+                                       sidecar=self._sidecar(path, table_path))
+                entry = (h5file, table, index)
+            self._open[path] = entry
+        return entry
+
+    def close(self):
+        with hdf5_lock:
+            while len(self._open) > 0:
+                path, (h5file, table, index) = self._open.popitem()
+                h5file.close()
+
+    def time_limits(self):
+        if self.bounds is None:
+            return -np.inf, np.inf
+        return getattr(self.bounds, self.time_name)
+
+    def files_in(self, t_min, t_max):
+        """ Positions in the catalog of the files that overlap t_min to t_max """
+        return np.flatnonzero((self.catalog['t_max'] >= t_min) & (self.catalog['t_min'] <= t_max))
+
+    def read_events(self, t_min, t_max):
+        """ Events from all files with t_min <= time <= t_max, with their global
+            row numbers in index_name
+        """
+        parts = []
+        for i in self.files_in(t_min, t_max):
+            with hdf5_lock:
+                h5file, table, index = self._table(i)
+                rows = index.rows(t_min, t_max)
+                events = table.read_coordinates(rows)
+            parts.append(append_fields(events, self.index_name, rows + self.catalog['row_offset'][i],
+                                       usemask=False))
+        if len(parts) == 0:
+            with hdf5_lock:
+                h5file, table, index = self._table(0)
+                events = table.read(0, 0)
+            return append_fields(events, self.index_name, np.empty(0, dtype='i8'), usemask=False)
+        return np.concatenate(parts)
+
+    def file_rows(self, indices):
+        """ Split global row indices into (catalog position, rows in file, positions
+            in indices) for each file
+        """
+        indices = np.asarray(indices)
+        which = np.searchsorted(self.catalog['row_offset'], indices, side='right') - 1
+        for i in np.unique(which):
+            here = np.flatnonzero(which == i)
+            yield i, indices[here] - self.catalog['row_offset'][i], here
+
+    @coroutine
+    def update(self, index_name="hdf_row_idx", field_names=None):
+        """ Write the values of field_names in the data received to the HDF5 files,
+            at the rows given by index_name.
+        """
+        while True:
+            a = (yield)
+            indices = a[index_name]
+            if field_names is None:
+                print("Did not update HDF5 files; field_names are required")
+                continue
+            with hdf5_lock:
+                for i, rows, here in self.file_rows(indices):
+                    h5file, table, index = self._table(i, writable=True)
+                    for field_name in field_names:
+                        write_column(table, field_name, a[field_name][here], rows)
+                    h5file.flush()
+            self.version += 1
+            get_exchange('B4D_dataset_updated').send((self, field_names, indices))
+
+    def send(self, msg):
+        """ SD_reflow_start messages are sent here """
+        if self.target is not None:
+            self.target.send(self.read_events(*self.time_limits()))
@@ -4,16 +4,26 @@
     understood by the lmatools package.
 
 """
+from __future__ import absolute_import, print_function
+
 import numpy as np
 
 from lmatools.flashsort.autosort.LMAarrayFile import LMAdataFile
 
-from stormdrain.bounds import Bounds, BoundsFilter
+from stormdrain.bounds import Bounds
 from stormdrain.data import NamedArrayDataset, indexed
 from stormdrain.pipeline import Branchpoint, coroutine, ItemModifier
-from stormdrain.support.matplotlib.artistupdaters import PanelsScatterController
 from stormdrain.support.matplotlib.poly_lasso import LassoPayloadController
 
+from brawl4d.filters import TimeWindowFilter, FusedBoundsFilter
+from brawl4d.selection import project_selection
+from brawl4d.artists import PanelsScatterController, LevelOfDetailFilter, DensityRasterSwitch
+from brawl4d.cache import ViewCache
+from brawl4d.LMA.sidecar import load_sidecar, write_sidecar
+from brawl4d.LMA.lylout import read_lylout_files
+from brawl4d.LMA.flash_index import FlashIndex, FlashEventIndex
+from brawl4d.LMA.flash_stats import FlashAggregator
+
 class LMAAnimator(object):
     
     
@@ -45,7 +55,12 @@ class LMAController(object):
     def pipeline_for_dataset(self, d, panels, 
                              names4d=('lon', 'lat', 'alt', 'time'),
                              transform_mapping=None,
-                             scatter_kwargs = {}
+                             scatter_kwargs = {},
+                             zero_copy=False,
+                             cache_projection=False,
+                             max_per_pixel=None,
+                             raster_min_points=None,
+                             view_cache_bytes=None
                              ):
         """ Set 4d_names to the spatial coordinate names in d that provide 
             longitude, latitude, altitude, and time. Default of 
@@ -53,6 +68,30 @@ class LMAController(object):
         
             entries in the scatter_kwargs dictionary are passed as kwargs to the matplotlib
             scatter call.
+            
+            If zero_copy is True, the stages of the pipeline pass along a Selection
+            (an index into the dataset's array) instead of copying every field of the
+            selected rows at each stage. Fields are gathered only where they are used,
+            e.g., by the scatter artists.
+            
+            If cache_projection is True, the projected x, y, z coordinates of the
+            whole dataset are calculated once and kept until the center of panels.cs
+            changes, so that panning and zooming only need to filter. This is meant
+            for datasets that send the same array on every reflow.
+            
+            If max_per_pixel is given, no more than that many points are drawn in
+            each pixel of each panel, as described in LevelOfDetailFilter. Taps on 
+            scatter_ctrl.branchpoint still receive all points in the view.
+            
+            If raster_min_points is given, views with at least that many points 
+            are shown as point density rasters instead of scatter plots. See
+            DensityRasterSwitch.
+            
+            If view_cache_bytes is given, the data reaching the scatter artists are
+            kept for recently seen views, up to that many bytes, and returning to
+            one of those views skips the pipeline. See ViewCache. Taps on the
+            returned branch don't see reflows served from the cache; taps on
+            scatter_ctrl.branchpoint do.
         """
         # Set up dataset -> time-height bound filter -> brancher
         branch = Branchpoint([])
@@ -61,15 +100,39 @@ class LMAController(object):
         # strictly speaking, z in the map projection and MSL alt aren't the same - z is somewhat distorted by the projection.
         # therefore, add some padding. filtered again later after projection.
         
-        quality_filter = BoundsFilter(target=brancher, bounds=self.bounds).filter()
+        # All active LMA quality criteria and any panel bounds criteria that apply to
+        # fields in the dataset are evaluated together in one chunked pass. Time has
+        # already been taken care of by the time window. Cached projected coordinates
+        # are left for the final filter so that the brancher sees the same data
+        # whether or not the projection is cached.
+        pre_projection_exclude = ('time',)
+        if cache_projection:
+            pre_projection_exclude += ('x', 'y', 'z')
+        quality_filter = FusedBoundsFilter(target=brancher, bounds=(self.bounds, panels.bounds),
+                                           exclude=pre_projection_exclude).filter()
         if transform_mapping is None:
             transform_mapping = self.z_alt_mapping
         # Use 'time', which is the name in panels.bounds, and not names4d[3], which should
-        # is linked to 'time' by transform_mapping if necessary
-        bound_filter = BoundsFilter(target=quality_filter, bounds=panels.bounds, 
-                                    restrict_to=('time'), transform_mapping=transform_mapping)
+        # is linked to 'time' by transform_mapping if necessary. The time window is found
+        # by binary search on a time index built once per data array.
+        bound_filter = TimeWindowFilter(target=panels.reflow_checkpoint(quality_filter), bounds=panels.bounds, 
+                                    transform_mapping=transform_mapping, as_selection=zero_copy)
         filterer = bound_filter.filter()
-        d.target = filterer
+        view_cache = None
+        if view_cache_bytes is not None:
+            view_cache = ViewCache(d, bounds=(panels.bounds, self.bounds), 
+                                   max_bytes=view_cache_bytes,
+                                   key_extra=(lambda: panels.cs.center))
+            filterer = view_cache.lookup(filterer)
+        if cache_projection:
+            d.target = panels.cs.cached_projection(
+                            target=filterer,
+                            x_coord='x', y_coord='y', z_coord='z', 
+                            lat_coord=names4d[1], lon_coord=names4d[0], alt_coord=names4d[2],
+                            distance_scale_factor=1.0e-3)
+        else:
+            d.target = filterer
+        panels.add_reflow_receiver(d)
         
         # Set up brancher -> coordinate transform -> final_filter -> mutli-axis scatter updater
         scatter_ctrl = PanelsScatterController(
@@ -77,11 +140,34 @@ class LMAController(object):
                             color_field=names4d[3], 
                             default_color_bounds=self.default_color_bounds,
                             **scatter_kwargs)
+        if max_per_pixel is not None:
+            lod = LevelOfDetailFilter(panels, max_per_pixel=max_per_pixel,
+                                      field_map={'time':names4d[3]})
+            scatter_ctrl.add_artist_stage(lod, lod.decimate())
+        if raster_min_points is not None:
+            raster_switch = DensityRasterSwitch(panels, scatter_ctrl, 
+                                                min_points=raster_min_points,
+                                                field_map={'time':names4d[3]})
+            scatter_ctrl.add_artist_stage(raster_switch, raster_switch.switch())
         scatter_outlet_broadcaster = scatter_ctrl.branchpoint
         scatter_updater = scatter_outlet_broadcaster.broadcast() 
-        final_bound_filter = BoundsFilter(target=scatter_updater, bounds=panels.bounds)
+        final_target = panels.gui_stage(scatter_updater)
+        if view_cache is not None:
+            view_cache.hit_target = panels.gui_stage(scatter_updater)
+            final_target = view_cache.store(final_target)
+        final_bound_filter = FusedBoundsFilter(target=final_target, bounds=(panels.bounds,))
         final_filterer = final_bound_filter.filter()
-        cs_transformer = panels.cs.project_points(
+        if cache_projection:
+            # Already projected before the time window
+            cs_transformer = final_filterer
+        elif zero_copy:
+            cs_transformer = project_selection(panels.cs,
+                            target=final_filterer, 
+                            x_coord='x', y_coord='y', z_coord='z', 
+                            lat_coord=names4d[1], lon_coord=names4d[0], alt_coord=names4d[2],
+                            distance_scale_factor=1.0e-3)
+        else:
+            cs_transformer = panels.cs.project_points(
                             target=final_filterer, 
                             x_coord='x', y_coord='y', z_coord='z', 
                             lat_coord=names4d[1], lon_coord=names4d[0], alt_coord=names4d[2],
@@ -92,7 +178,10 @@ class LMAController(object):
         return branch, scatter_ctrl
     
     @coroutine
-    def flash_stat_printer(self, min_points=10):
+    def flash_stat_printer(self, min_points=10, aggregator=None):
+        """ Print a summary of the flashes in view. If aggregator is given, its
+            per-flash stats of the events in view are summarized too.
+        """
         while True:
             ev, fl = (yield)
             if fl is not None:
@@ -101,27 +190,45 @@ class LMAController(object):
                 good = (fl['n_points'] >= min_points)
                 N_good = len(fl[good])
                 area = np.mean(fl['area'][good])
-                print template.format(N_good, N, area, min_points)
+                print(template.format(N_good, N, area, min_points))
+            if aggregator is not None:
+                stats = aggregator.stats
+                stats = stats[stats['n_events'] >= min_points]
+                if len(stats) > 0:
+                    template = ("{0} flashes have >= {1} points in view. Median duration = {2:5.3f} s, "
+                                "median altitude = {3:5.2f} km, total power = {4:7.1f} dBW")
+                    alt_median = np.median(stats['{0}_p50'.format(aggregator.alt_name)])/1.0e3
+                    print(template.format(len(stats), min_points, np.median(stats['duration']),
+                                          alt_median, 10.0*np.log10(stats['power_sum'].sum())))
         
-    def flash_stats_for_dataset(self, d, selection_broadcaster):
-        
-        flash_stat_branchpoint = Branchpoint([self.flash_stat_printer()])
-        flash_stat_brancher = flash_stat_branchpoint.broadcast()
+    def flash_stats_for_dataset(self, d, selection_broadcaster, aggregator=None):
+        """ Send the events in view and their flashes to the returned branchpoint.
+            Per-flash aggregates of the events in view are kept up to date in 
+            aggregator.stats, which is a new FlashAggregator if not given.
+        """
+        if aggregator is None:
+            aggregator = FlashAggregator()
+        flash_stat_branchpoint = Branchpoint([self.flash_stat_printer(aggregator=aggregator)])
+        flash_stat_brancher = aggregator.update_stage(flash_stat_branchpoint.broadcast(),
+                                                      version=lambda: getattr(d, 'version', None))
         
         @coroutine
         def flash_data_for_selection(target, flash_id_key = 'flash_id'):
             """ Accepts an array of event data from the pipeline, and sends 
                 event and flash data.
+                
+                The flash_id to row index of the flash data is built the first 
+                time they are seen, so each lookup costs in proportion to the
+                number of events.
             """
+            index = None
             while True:
                 ev = (yield) # array of event data
                 try:
                     fl_dat = d.flash_data
-                
-                    flash_ids = set(ev[flash_id_key])
-                    flashes = np.fromiter(
-                                (fl for fl in fl_dat if fl[flash_id_key] in flash_ids), 
-                                dtype=fl_dat.dtype)
+                    if (index is None) or (index.data is not fl_dat):
+                        index = FlashIndex(fl_dat, flash_id_key=flash_id_key)
+                    flashes = index.flashes_for_events(ev)
                 except AttributeError:
                     # There are no flash data in the dataset
                     flashes = None
@@ -133,12 +240,63 @@ class LMAController(object):
         
         
         
+    def sidecar_data(self, source, read):
+        """ Memory-mapped data from the columnar sidecar of source, creating the
+            sidecar from the data of the dataset returned by read() if needed.
+            Returns (data, dataset), where dataset is the result of read() if it
+            was called, and data is None if the sidecar couldn't be used.
+            The columns are mapped copy-on-write, so edits (e.g., charge) are
+            made in memory only.
+        """
+        data = load_sidecar(source, mmap_mode='c')
+        if data is not None:
+            return data, None
+        d = read()
+        if write_sidecar(source, d.data):
+            data = load_sidecar(source, mmap_mode='c')
+        return data, d
+        
     @indexed()
-    def read_dat(self, *args, **kwargs):
-        """ All args and kwargs are passed to the LMAdataFile object from lmatools"""
+    def _read_dat(self, *args, **kwargs):
         lma = LMAdataFile(*args, **kwargs)
         stn = lma.stations # adds stations to lma.data as a side-effect
         d = NamedArrayDataset(lma.data)
+        return d
+        
+    @indexed()
+    def _read_dat_files(self, filenames, processes=None):
+        header, data = read_lylout_files(filenames, processes=processes)
+        return NamedArrayDataset(data)
+        
+    def read_dat_files(self, filenames, processes=None):
+        """ Read one or more LYLOUT .dat or .dat.gz files with the brawl4d reader,
+            using a pool of processes, into one dataset. Times are seconds from the
+            start of the day of the first file. See LMA.lylout.
+        """
+        d = self._read_dat_files(list(filenames), processes=processes)
+        self.datasets.add(d)
+        return d
+        
+    def read_dat(self, *args, **kwargs):
+        """ All args and kwargs are passed to the LMAdataFile object from lmatools,
+            except sidecar and fast. If sidecar is True, the parsed data are kept in
+            a columnar sidecar next to the file, which is used instead of parsing
+            the file on later loads. See LMA.sidecar. If fast is True, the file is
+            parsed with the brawl4d reader instead; see read_dat_files.
+        """
+        sidecar = kwargs.pop('sidecar', False)
+        if kwargs.pop('fast', False):
+            read = lambda: self._read_dat_files([args[0]], processes=1)
+        else:
+            read = lambda: self._read_dat(*args, **kwargs)
+        if sidecar:
+            data, d = self.sidecar_data(args[0], read)
+            if d is None:
+                d = NamedArrayDataset(data)
+            elif data is not None:
+                d.data = data
+        else:
+            d = read()
         self.datasets.add(d)
         return d
         
@@ -158,31 +316,88 @@ class LMAController(object):
         
         return d, post_filter_brancher, scatter_ctrl, charge_lasso
         
-    @indexed(index_name='hdf_row_idx')     
-    def read_hdf5(self, LMAfileHDF):
+    def _open_hdf5(self, LMAfileHDF, data=None):
         try:
             import tables
         except ImportError:
-            print "couldn't import pytables"
+            print("couldn't import pytables")
             return None
-        from hdf5_lma import HDF5Dataset
-        
-        # get the HDF5 table name
-        LMAh5 = tables.openFile(LMAfileHDF, 'r')
-        table_names = LMAh5.root.events._v_children.keys()
-        table_path = '/events/' + table_names[0]
-        LMAh5.close()
-        d = HDF5Dataset(LMAfileHDF, table_path=table_path, mode='a')
+        from .hdf5_lma import HDF5Dataset
+        
+        # The first events table in the file
+        d = HDF5Dataset(LMAfileHDF, mode='a', data=data)
+        
+        if d.flash_table is not None:
+            print("found flash data")
+        
+        return d
+        
+    @indexed(index_name='hdf_row_idx')     
+    def _read_hdf5(self, LMAfileHDF):
+        return self._open_hdf5(LMAfileHDF)
+        
+    def read_hdf5(self, LMAfileHDF, sidecar=False):
+        """ If sidecar is True, the events table (with hdf_row_idx) is kept in a
+            columnar sidecar next to the file, which is memory-mapped instead of
+            reading the table on later loads. See LMA.sidecar.
+        """
+        if sidecar:
+            data, d = self.sidecar_data(LMAfileHDF, lambda: self._read_hdf5(LMAfileHDF))
+            if d is None:
+                d = self._open_hdf5(LMAfileHDF, data=data)
+            elif data is not None:
+                d.data = data
+        else:
+            d = self._read_hdf5(LMAfileHDF)
+        self.datasets.add(d)
+        return d
+        
+    def read_hdf5_lazy(self, LMAfileHDF, bounds=None):
+        """ Open LMAfileHDF without loading the tables into memory. Each reflow
+            reads the data in the time range of bounds. See HDF5LazyDataset.
+        """
+        from .hdf5_lma import HDF5LazyDataset
+        
+        d = HDF5LazyDataset(LMAfileHDF, mode='a', bounds=bounds,
+                            index_name='hdf_row_idx')
         self.datasets.add(d)
         
         if d.flash_table is not None:
-            print "found flash data"
+            print("found flash data")
         
         return d
         
-    def load_hdf5_to_panels(self, panels, LMAfileHDF, scatter_kwargs={}):
-        d = self.read_hdf5(LMAfileHDF)
-        post_filter_brancher, scatter_ctrl = self.pipeline_for_dataset(d, panels, scatter_kwargs=scatter_kwargs)
+    def read_hdf5_archive(self, paths, bounds=None, max_open=8):
+        """ Treat many LMA HDF5 files, given by a directory, glob pattern, or list of
+            file names, as one dataset. Each reflow reads the data in the time
+            range of bounds from the files that overlap it. See HDF5ArchiveDataset.
+        """
+        from .archive import HDF5ArchiveDataset
+        d = HDF5ArchiveDataset(paths, mode='a', bounds=bounds, max_open=max_open,
+                               index_name='hdf_row_idx')
+        self.datasets.add(d)
+        print("found {0} files".format(len(d.catalog)))
+        return d
+        
+    def load_hdf5_to_panels(self, panels, LMAfileHDF, scatter_kwargs={}, zero_copy=False,
+                            cache_projection=False, max_per_pixel=None, raster_min_points=None,
+                            view_cache_bytes=None, lazy=False, archive=False, sidecar=False):
+        """ If lazy is True, the file is read one time window at a time instead
+            of all at once; see read_hdf5_lazy. If archive is True, LMAfileHDF is a
+            directory, glob pattern, or list of files that are all read that way;
+            see read_hdf5_archive. If sidecar is True, the data are memory-mapped
+            from a columnar sidecar; see read_hdf5.
+        """
+        if archive:
+            d = self.read_hdf5_archive(LMAfileHDF, bounds=panels.bounds)
+        elif lazy:
+            d = self.read_hdf5_lazy(LMAfileHDF, bounds=panels.bounds)
+        else:
+            d = self.read_hdf5(LMAfileHDF, sidecar=sidecar)
+        post_filter_brancher, scatter_ctrl = self.pipeline_for_dataset(d, panels, 
+                scatter_kwargs=scatter_kwargs, zero_copy=zero_copy,
+                cache_projection=cache_projection, max_per_pixel=max_per_pixel,
+                raster_min_points=raster_min_points, view_cache_bytes=view_cache_bytes)
         branch_to_scatter_artists = scatter_ctrl.branchpoint
         charge_lasso = LassoChargeController(
                             target=ItemModifier(
@@ -195,12 +410,25 @@ class LMAController(object):
         
     def load_hdf5_flashes_to_panels(self, panels, hdf5dataset, min_points=10):
         """ Set up a flash dataset display. The sole argument is usually the HDF5 
-            LMA dataset returned by a call to self.load_hdf5_to_panels """
-        from hdf5_lma import HDF5FlashDataset
+            LMA dataset returned by a call to self.load_hdf5_to_panels 
+            
+            If the events are in memory, a FlashEventIndex relating the flashes
+            and events is built and kept as flash_d.event_index. For instance, to
+            show the events of the flashes in view,
+            flash_scatter_ctrl.branchpoint.targets.add(
+                flash_d.event_index.events_for_flashes(target=...))
+            and to get the flashes of lassoed events (with hdf_row_idx), send them
+            to flash_d.event_index.flashes_for_events(target=...).
+        """
+        from .hdf5_lma import HDF5FlashDataset
         if hdf5dataset.flash_table is not None:
             point_count_dtype = hdf5dataset.flash_data['n_points'].dtype
-            self.bounds.n_points = (min_points, np.iinfo(point_count_dtype))
+            self.bounds.n_points = (min_points, np.iinfo(point_count_dtype).max)
             flash_d = HDF5FlashDataset(hdf5dataset)
+            flash_d.event_index = None
+            if hdf5dataset.data is not None:
+                flash_d.event_index = FlashEventIndex(hdf5dataset.data, hdf5dataset.flash_data,
+                                                      index_name='hdf_row_idx')
             transform_mapping = {}
             transform_mapping['time'] = ('start', (lambda v: (v[0], v[1])) )
             transform_mapping['lat'] = ('init_lat', (lambda v: (v[0], v[1])) )
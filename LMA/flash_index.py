@@ -0,0 +1,131 @@
+""" Indexes relating LMA events to the flashes they belong to.
+
+"""
+import numpy as np
+
+from stormdrain.pipeline import coroutine
+
+
+class FlashIndex(object):
+    """ Row of each flash_id in flash_data, for vectorized lookup.
+
+        If the ids are dense enough (no more than density_limit times as many
+        possible ids as flashes), a lookup array indexed by id is used. Otherwise
+        the ids are sorted once and looked up with searchsorted.
+    """
+    def __init__(self, flash_data, flash_id_key='flash_id', density_limit=4):
+        self.data = flash_data
+        self.flash_id_key = flash_id_key
+        ids = np.asarray(flash_data[flash_id_key])
+        self.n_flashes = ids.shape[0]
+        self.lookup = None
+        if self.n_flashes == 0:
+            self.min_id = 0
+            self.lookup = np.empty(0, dtype='i8')
+            return
+        self.min_id, max_id = ids.min(), ids.max()
+        span = int(max_id) - int(self.min_id) + 1
+        if span <= density_limit*self.n_flashes + 1024:
+            self.lookup = np.empty(span, dtype='i8')
+            self.lookup.fill(-1)
+            self.lookup[ids - self.min_id] = np.arange(self.n_flashes)
+        else:
+            self.order = np.argsort(ids, kind='mergesort')
+            self.sorted_ids = ids[self.order]
+
+    def rows_for_ids(self, ids):
+        """ Row in flash_data of each of ids, or -1 where there is no such flash """
+        ids = np.asarray(ids)
+        rows = np.empty(ids.shape[0], dtype='i8')
+        rows.fill(-1)
+        if self.lookup is not None:
+            offset = ids.astype('i8') - self.min_id
+            valid = (offset >= 0) & (offset < self.lookup.shape[0])
+            rows[valid] = self.lookup[offset[valid]]
+        else:
+            pos = np.searchsorted(self.sorted_ids, ids)
+            pos[pos == self.n_flashes] = 0
+            found = (self.sorted_ids[pos] == ids)
+            rows[found] = self.order[pos[found]]
+        return rows
+
+    def rows_for_events(self, events):
+        """ Sorted rows in flash_data of the flashes that events belong to """
+        ids = np.asarray(events[self.flash_id_key])
+        if self.lookup is None:
+            # Fewer binary searches, since events of the same flash share an id
+            ids = np.unique(ids)
+        rows = self.rows_for_ids(ids)
+        selected = np.zeros(self.n_flashes, dtype=bool)
+        selected[rows[rows >= 0]] = True
+        return np.flatnonzero(selected)
+
+    def flashes_for_events(self, events):
+        """ The flashes that events belong to, in the order of flash_data """
+        return self.data[self.rows_for_events(events)]
+
+
+class FlashEventIndex(object):
+    """ Compressed sparse row index from flashes to their events, for going back
+        and forth between a selection of flashes and a selection of events.
+
+        The events of the flash in row i of flash_data are the rows
+        event_order[offsets[i]:offsets[i+1]] of events, and the flash of each
+        event is in event_flash_row (-1 if the flash isn't in flash_data).
+
+        events_for_flashes and flashes_for_events are pipeline stages that turn
+        flash data into the data for their events, and event data (with the row
+        of each event in index_name) into the data for their flashes.
+    """
+    def __init__(self, events, flash_data, flash_id_key='flash_id', index_name='hdf_row_idx'):
+        self.events = events
+        self.flash_data = flash_data
+        self.index_name = index_name
+        self.flash_index = FlashIndex(flash_data, flash_id_key=flash_id_key)
+        n_flashes = self.flash_index.n_flashes
+        flash_row = self.flash_index.rows_for_ids(events[flash_id_key])
+        self.event_flash_row = flash_row
+        order = np.argsort(flash_row, kind='mergesort')
+        n_unmatched = np.count_nonzero(flash_row < 0)
+        self.event_order = order[n_unmatched:]
+        counts = np.bincount(flash_row[flash_row >= 0], minlength=n_flashes)
+        self.offsets = np.zeros(n_flashes + 1, dtype='i8')
+        np.cumsum(counts, out=self.offsets[1:])
+
+    def event_rows(self, flash_rows):
+        """ Rows of the events of the flashes in flash_rows, grouped by flash """
+        flash_rows = np.asarray(flash_rows)
+        starts = self.offsets[flash_rows]
+        counts = self.offsets[flash_rows + 1] - starts
+        total = counts.sum()
+        if total == 0:
+            return np.empty(0, dtype=self.event_order.dtype)
+        # Position in event_order of each event: the start of its flash, plus its
+        # position within its flash.
+        group_start = np.cumsum(counts) - counts
+        pos = np.arange(total) + np.repeat(starts - group_start, counts)
+        return self.event_order[pos]
+
+    def event_rows_for_ids(self, flash_ids):
+        rows = self.flash_index.rows_for_ids(flash_ids)
+        return self.event_rows(rows[rows >= 0])
+
+    def flash_rows(self, event_rows):
+        """ Sorted rows in flash_data of the flashes of the events in event_rows """
+        rows = self.event_flash_row[np.asarray(event_rows)]
+        selected = np.zeros(self.flash_index.n_flashes, dtype=bool)
+        selected[rows[rows >= 0]] = True
+        return np.flatnonzero(selected)
+
+    @coroutine
+    def events_for_flashes(self, target):
+        while True:
+            fl = (yield)
+            rows = self.event_rows_for_ids(fl[self.flash_index.flash_id_key])
+            target.send(self.events[rows])
+
+    @coroutine
+    def flashes_for_events(self, target):
+        while True:
+            ev = (yield)
+            target.send(self.flash_data[self.flash_rows(ev[self.index_name])])
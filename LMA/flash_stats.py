@@ -0,0 +1,164 @@
+""" Per-flash statistics of the LMA events in view.
+
+"""
+import numpy as np
+
+from stormdrain.pipeline import coroutine
+
+
+def in_sorted(values, sorted_values):
+    """ Boolean mask of the values that are in sorted_values, by binary search """
+    if sorted_values.shape[0] == 0:
+        return np.zeros(values.shape[0], dtype=bool)
+    pos = np.searchsorted(sorted_values, values)
+    pos[pos == sorted_values.shape[0]] = 0
+    return sorted_values[pos] == values
+
+
+class FlashAggregator(object):
+    """ Aggregates of the events in view, grouped by flash_id: the number of
+        events, the sum of their power, the first and last event times and the
+        duration, the range of each of extent_fields, and percentiles of altitude.
+        Event power is in dBW, as in LMA data files, and is summed as linear power
+        in W, so that power_sum of several flashes can be added;
+        10*np.log10(power_sum) is the total in dBW.
+
+        The events are sorted once by flash_id (and altitude within each flash),
+        and each aggregate is a numpy reduceat over the groups, so the cost is
+        that of one sort. The result is kept in stats, a named array in order of
+        flash_id.
+
+        When the events have a row number in index_name (as from an HDF5Dataset),
+        each update finds the events that entered or left the view since the last
+        one, and only the flashes that they belong to are aggregated again. As a
+        time window slides, that is only the flashes near its ends. If more than
+        max_changed of the flashes have changed, or the version passed to update
+        has changed (the values of the data were edited), all flashes are
+        aggregated again.
+
+        Events without all of the fields needed (e.g., before flashes are sorted,
+        there is no flash_id) leave stats empty.
+    """
+    def __init__(self, flash_id_key='flash_id', time_name='time', power_name='power',
+                 alt_name='alt', extent_fields=('lon', 'lat', 'alt'),
+                 percentiles=(10, 50, 90), index_name='hdf_row_idx', max_changed=0.5):
+        self.flash_id_key = flash_id_key
+        self.time_name = time_name
+        self.power_name = power_name
+        self.alt_name = alt_name
+        self.extent_fields = extent_fields
+        self.percentiles = percentiles
+        self.index_name = index_name
+        self.max_changed = max_changed
+        descr = [(flash_id_key, 'i8'), ('n_events', 'i8'), ('power_sum', 'f8'),
+                 ('t_start', 'f8'), ('t_end', 'f8'), ('duration', 'f8')]
+        for name in extent_fields:
+            descr += [(name + '_min', 'f8'), (name + '_max', 'f8')]
+        descr += [('{0}_p{1}'.format(alt_name, q), 'f8') for q in percentiles]
+        self.dtype = np.dtype(descr)
+        self.full_updates = 0
+        self.incremental_updates = 0
+        self.reset()
+
+    def reset(self):
+        self.stats = np.zeros(0, dtype=self.dtype)
+        self.version = None
+        self._rows = None
+        self._ids = None
+
+    def aggregate(self, ev, rows=None):
+        """ Aggregates for the events in ev (a named array or Selection), or
+            only those selected by rows (an index array or boolean mask).
+        """
+        def column(name):
+            values = np.asarray(ev[name])
+            if rows is not None:
+                values = values[rows]
+            return values
+        ids = column(self.flash_id_key)
+        n = ids.shape[0]
+        stats = np.zeros(0, dtype=self.dtype)
+        if n == 0:
+            return stats
+        alt = column(self.alt_name)
+        order = np.lexsort((alt, ids))
+        ids = ids[order]
+        starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+        counts = np.diff(np.concatenate((starts, [n])))
+        stats = np.zeros(starts.shape[0], dtype=self.dtype)
+        stats[self.flash_id_key] = ids[starts]
+        stats['n_events'] = counts
+        power = 10.0**(column(self.power_name)[order].astype('f8')/10.0)
+        stats['power_sum'] = np.add.reduceat(power, starts)
+        t = column(self.time_name)[order]
+        stats['t_start'] = np.minimum.reduceat(t, starts)
+        stats['t_end'] = np.maximum.reduceat(t, starts)
+        stats['duration'] = stats['t_end'] - stats['t_start']
+        for name in self.extent_fields:
+            values = column(name)[order]
+            stats[name + '_min'] = np.minimum.reduceat(values, starts)
+            stats[name + '_max'] = np.maximum.reduceat(values, starts)
+        # Altitudes are sorted within each flash, so percentiles are interpolated
+        # between neighbors, as np.percentile does.
+        alt = alt[order].astype('f8')
+        last = starts + counts - 1
+        for q in self.percentiles:
+            pos = starts + (q/100.0)*(counts - 1)
+            lo = np.floor(pos).astype('i8')
+            hi = np.minimum(lo + 1, last)
+            frac = pos - lo
+            stats['{0}_p{1}'.format(self.alt_name, q)] = alt[lo] + (alt[hi] - alt[lo])*frac
+        return stats
+
+    def update(self, ev, version=None):
+        """ Bring stats up to date for the events now in view, ev, and return them """
+        names = ev.dtype.names
+        needed = ((self.flash_id_key, self.time_name, self.power_name, self.alt_name) +
+                  tuple(self.extent_fields))
+        if any(name not in names for name in needed):
+            self.reset()
+            return self.stats
+        incremental = ((self._rows is not None) and (self.index_name in names) and
+                       (version == self.version))
+        self.version = version
+        if self.index_name not in names:
+            self._rows = None
+            self.stats = self.aggregate(ev)
+            self.full_updates += 1
+            return self.stats
+        # Rows (and the flash of each) are kept sorted for binary searches. Rows
+        # from a time window are usually in order already.
+        rows = np.array(ev[self.index_name])
+        ids = np.array(ev[self.flash_id_key])
+        if (rows.shape[0] > 1) and (np.diff(rows) < 0).any():
+            order = np.argsort(rows, kind='mergesort')
+            rows, ids = rows[order], ids[order]
+        if incremental:
+            entering = ~in_sorted(rows, self._rows)
+            leaving = ~in_sorted(self._rows, rows)
+            changed = np.unique(np.concatenate((ids[entering], self._ids[leaving])))
+            incremental = changed.shape[0] <= self.max_changed*self.stats.shape[0]
+        if incremental:
+            if changed.shape[0] > 0:
+                kept = self.stats[~in_sorted(self.stats[self.flash_id_key], changed)]
+                in_changed = in_sorted(np.asarray(ev[self.flash_id_key]), changed)
+                fresh = self.aggregate(ev, np.flatnonzero(in_changed))
+                stats = np.concatenate((kept, fresh))
+                self.stats = stats[np.argsort(stats[self.flash_id_key], kind='mergesort')]
+            self.incremental_updates += 1
+        else:
+            self.stats = self.aggregate(ev)
+            self.full_updates += 1
+        self._rows, self._ids = rows, ids
+        return self.stats
+
+    @coroutine
+    def update_stage(self, target, version=None):
+        """ Receives (events, flashes) from LMAController.flash_stats_for_dataset,
+            updates stats and sends the message on. version is a callable that
+            returns the version of the dataset, if any.
+        """
+        while True:
+            ev, fl = (yield)
+            self.update(ev, version=None if version is None else version())
+            target.send((ev, fl))
@@ -1,8 +1,28 @@
+from __future__ import absolute_import, print_function
+
+import os
+import threading
+
+import numpy as np
 import tables
+from numpy.lib.recfunctions import append_fields
 
 from stormdrain.pipeline import coroutine
 from stormdrain.pubsub import get_exchange
 
+from .sidecar import _source_stamp
+
+# Held for all access to HDF5 files, since with a ReflowScheduler in the
+# background, reflows read files in the worker thread while edits are written
+# in the GUI thread. The HDF5 library isn't thread-safe even for different
+# files, so there is one lock for all of them.
+hdf5_lock = threading.RLock()
+
+def events_table_path(h5file):
+    """ Path to the first events table in an LMA HDF5 file """
+    table_names = sorted(h5file.root.events._v_children.keys())
+    return '/events/' + table_names[0]
+
 class HDF5FlashDataset(object):
     """ Provides an pipeline source for the flash table part of an HDF5Dataset"""
     def __init__(self, h5dataset, target=None):
@@ -15,32 +35,136 @@ class HDF5FlashDataset(object):
         if self.target is not None:
             self.target.send(self.h5dataset.flash_data)
 
+def sorted_edits(coldata, row_ids):
+    """ Sort edits by row. Where a row is edited more than once, the last edit wins. """
+    row_ids = np.asarray(row_ids, dtype='i8')
+    coldata = np.asarray(coldata)
+    order = np.argsort(row_ids, kind='mergesort')
+    row_ids, coldata = row_ids[order], coldata[order]
+    last = np.ones(row_ids.shape[0], dtype=bool)
+    last[:-1] = (row_ids[1:] != row_ids[:-1])
+    return coldata[last], row_ids[last]
+
+
+def write_column(table, colname, coldata, row_ids, max_gap=8192, min_density=1.0/64):
+    """ Write coldata to column colname of table at row_ids, in bulk.
+    
+        Rows no more than max_gap apart are grouped into spans. A span is written
+        by reading that part of the column, assigning the edits, and writing it
+        back with modify_column. A span with fewer than min_density edits per row,
+        along with any scattered rows, is written with one read_coordinates and
+        modify_coordinates instead.
+    """
+    coldata, row_ids = sorted_edits(coldata, row_ids)
+    if row_ids.shape[0] == 0:
+        return
+    breaks = np.flatnonzero(np.diff(row_ids) > max_gap) + 1
+    starts = np.concatenate(([0], breaks))
+    stops = np.concatenate((breaks, [row_ids.shape[0]]))
+    scattered = []
+    for i0, i1 in zip(starts, stops):
+        r0, r1 = row_ids[i0], row_ids[i1-1] + 1
+        if (i1 - i0) < min_density*(r1 - r0):
+            scattered.append(slice(i0, i1))
+            continue
+        span = table.read(r0, r1, field=colname)
+        span[row_ids[i0:i1] - r0] = coldata[i0:i1]
+        table.modify_column(start=r0, stop=r1, column=span, colname=colname)
+    if len(scattered) > 0:
+        coords = np.concatenate([row_ids[s] for s in scattered])
+        rows = table.read_coordinates(coords)
+        rows[colname] = np.concatenate([coldata[s] for s in scattered])
+        table.modify_coordinates(coords, rows)
+
+
 class HDF5Dataset(object):
-    def __init__(self, h5filename, table_path=None, target=None, mode='r'):
+    """ If write_behind is True, edits to the HDF5 file are queued and written
+        together, with a single flush, by flush_edits(). The data in memory are
+        always updated right away.
+        
+        If data are given, they are used in place of the contents of the table,
+        e.g., the same data from a sidecar.
+        
+        The file is opened read-only, and only reopened with mode when the first
+        edit is written. HDF5 rewrites files opened for writing when they are
+        closed, which would make the file look changed even if it was only viewed.
+        
+        If table_path is None, the first events table in the file is used.
+    """
+    def __init__(self, h5filename, table_path=None, target=None, mode='r', write_behind=False,
+                 data=None):
         self.target = target
+        self.write_behind = write_behind
+        self._pending_edits = []
+        # Incremented whenever the data are modified
+        self.version = 0
         
-        self.h5file = tables.openFile(h5filename, mode=mode)
-        self.table = self.h5file.getNode(table_path)
-        self.data = self.table[:]
+        self._open_tables(h5filename, table_path, mode)
+        if data is None:
+            data = self.table[:]
+        self.data = data
+        if self.flash_table is not None:
+            self.flash_data = self.flash_table[:]
         
         get_exchange('SD_reflow_start').attach(self)
         
+    def _open_tables(self, h5filename, table_path, mode):
+        """ Open h5filename read-only and find the events table at table_path
+            and the matching flash table, if there is one.
+        """
+        self.mode = mode
+        self.h5file = tables.open_file(h5filename, mode='r')
+        if table_path is None:
+            table_path = events_table_path(self.h5file)
+        self.table_path = table_path
+        self.table = self.h5file.get_node(table_path)
+        
         flash_table_path = table_path.replace('events', 'flashes')
+        self.flash_table_path = flash_table_path
         try:
-            self.flash_table = self.h5file.getNode(flash_table_path)
-            self.flash_data = self.flash_table[:]
+            self.flash_table = self.h5file.get_node(flash_table_path)
         except tables.NoSuchNodeError:
             self.flash_table = None
-            print "Did not find flash data at {0}".format(flash_table_path)
-        
+            print("Did not find flash data at {0}".format(flash_table_path))
 
+
+    def open_for_writing(self):
+        """ Reopen the file with the mode given when the dataset was created """
+        with hdf5_lock:
+            if (self.h5file.mode == 'r') and (self.mode != 'r'):
+                h5filename = self.h5file.filename
+                self.h5file.close()
+                self.h5file = tables.open_file(h5filename, mode=self.mode)
+                self.table = self.h5file.get_node(self.table_path)
+                if self.flash_table is not None:
+                    self.flash_table = self.h5file.get_node(self.flash_table_path)
+    
     def update_h5(self, colname, coldata, row_ids):
-        col = getattr(self.table.cols, colname)
-        # this indexing form doesn't work, though the PyTables hints for SQL users indicates it will
-        # manager.table[row_ids] = [ (colname,) + tuple(coldata) ]
-        for row_id, datum in zip(row_ids, coldata):
-            col[row_id] = datum
-        self.h5file.flush()
+        if self.write_behind:
+            self._pending_edits.append((colname, np.array(coldata), np.array(row_ids)))
+            return
+        with hdf5_lock:
+            self.open_for_writing()
+            write_column(self.table, colname, coldata, row_ids)
+            self.h5file.flush()
+    
+    def flush_edits(self):
+        """ Write all queued edits to the HDF5 file, one column at a time """
+        edits, self._pending_edits = self._pending_edits, []
+        if len(edits) == 0:
+            return
+        colnames = []
+        for colname, coldata, row_ids in edits:
+            if colname not in colnames:
+                colnames.append(colname)
+        with hdf5_lock:
+            self.open_for_writing()
+            for colname in colnames:
+                # Concatenated in the order the edits were made, so later edits win
+                coldata = np.concatenate([c for n, c, r in edits if n == colname])
+                row_ids = np.concatenate([r for n, c, r in edits if n == colname])
+                write_column(self.table, colname, coldata, row_ids)
+            self.h5file.flush()
     
     
     @coroutine
@@ -65,7 +189,9 @@ class HDF5Dataset(object):
             else:
                 # update everything
                 self.data[indices] = a
-                print "Did not update HDF5 file"
+                print("Did not update HDF5 file")
+            self.version += 1
+            get_exchange('B4D_dataset_updated').send((self, field_names, indices))
                 
         
     def send(self, msg):
@@ -74,4 +200,187 @@ class HDF5Dataset(object):
         # do we send the whole events table, or somehow dynamically determine that?
         
         if self.target is not None:
-            self.target.send(self.data)
\ No newline at end of file
+            self.target.send(self.data)
+
+class TimeChunkIndex(object):
+    """ Minimum and maximum of a time column for each block of chunk_rows rows of
+        an HDF5 table. Only the blocks that overlap a time window need to be
+        searched, so a query reads a small part of the table. The index is built
+        with one pass over the column, one block at a time.
+
+        If sidecar is given, the index is saved to and loaded from that .npz file
+        instead of modifying the HDF5 file. The sidecar is rebuilt if the table
+        has a different number of rows, or if the size or modification time of
+        the HDF5 file differ from when it was saved.
+
+        If extra_fields are given, the maximum of each over the whole table is kept
+        in field_max (e.g., the longest flash duration).
+    """
+    def __init__(self, table, time_name='time', chunk_rows=65536, sidecar=None, extra_fields=()):
+        self.table = table
+        self.time_name = time_name
+        self.chunk_rows = chunk_rows
+        self.field_max = {}
+        loaded = False
+        if (sidecar is not None) and os.path.exists(sidecar):
+            saved = np.load(sidecar)
+            size, mtime = _source_stamp(table._v_file.filename)
+            if ((int(saved['nrows']) == table.nrows) and (int(saved['chunk_rows']) == chunk_rows) and
+                    ('size' in saved) and (int(saved['size']) == size) and
+                    (float(saved['mtime']) == mtime)):
+                self.mins, self.maxs = saved['mins'], saved['maxs']
+                for name in extra_fields:
+                    self.field_max[name] = float(saved['max_'+name])
+                loaded = True
+        if not loaded:
+            with hdf5_lock:
+                self._build(extra_fields)
+            if sidecar is not None:
+                self._save(sidecar)
+
+    def _build(self, extra_fields):
+        n_chunks = (self.table.nrows + self.chunk_rows - 1) // self.chunk_rows
+        self.mins = np.empty(n_chunks, dtype='f8')
+        self.maxs = np.empty(n_chunks, dtype='f8')
+        for name in extra_fields:
+            self.field_max[name] = -np.inf
+        for i in range(n_chunks):
+            start = i*self.chunk_rows
+            stop = min(start + self.chunk_rows, self.table.nrows)
+            t = self.table.read(start, stop, field=self.time_name)
+            self.mins[i], self.maxs[i] = t.min(), t.max()
+            for name in extra_fields:
+                v = self.table.read(start, stop, field=name)
+                self.field_max[name] = max(self.field_max[name], v.max())
+
+    def _save(self, sidecar):
+        size, mtime = _source_stamp(self.table._v_file.filename)
+        saved = dict(nrows=self.table.nrows, chunk_rows=self.chunk_rows,
+                     size=size, mtime=mtime, mins=self.mins, maxs=self.maxs)
+        for name, v in self.field_max.items():
+            saved['max_'+name] = v
+        try:
+            np.savez(sidecar, **saved)
+        except (IOError, OSError):
+            print("Could not save time index to {0}".format(sidecar))
+
+    def row_ranges(self, t_min, t_max):
+        """ (start, stop) row ranges of the blocks that overlap t_min to t_max,
+            with adjacent blocks merged
+        """
+        overlap = (self.maxs >= t_min) & (self.mins <= t_max)
+        edges = np.diff(np.concatenate(([0], overlap.astype('i1'), [0])))
+        starts = np.flatnonzero(edges == 1)*self.chunk_rows
+        stops = np.minimum(np.flatnonzero(edges == -1)*self.chunk_rows, self.table.nrows)
+        return list(zip(starts, stops))
+
+    def rows(self, t_min, t_max):
+        """ Sorted row numbers with t_min <= time <= t_max. The comparison is
+            done by PyTables in-kernel, a block at a time.
+        """
+        condition = '({0} >= t_min) & ({0} <= t_max)'.format(self.time_name)
+        condvars = {'t_min': t_min, 't_max': t_max}
+        with hdf5_lock:
+            rows = [self.table.get_where_list(condition, condvars=condvars, start=start, stop=stop)
+                    for start, stop in self.row_ranges(t_min, t_max)]
+        if len(rows) == 0:
+            return np.empty(0, dtype='i8')
+        return np.concatenate(rows)
+
+
+class HDF5LazyDataset(HDF5Dataset):
+    """ Same as HDF5Dataset, but the tables are not loaded into memory. Instead, the
+        file is kept open and each reflow reads only the events (and flashes) in
+        the time range of bounds, so that memory use tracks the amount of data in
+        view. Use a Bounds object shared with the panels, e.g., panels.bounds.
+
+        The time index is kept in a sidecar file next to the HDF5 file; see
+        TimeChunkIndex. Flashes are searched by flash_time_name, extended earlier
+        by the longest flash duration so that all flashes with events in the
+        window are found.
+
+        The event data sent on each reflow include index_name, the row number of
+        each event in the table, which is used by update() to write changes to the
+        file. Since the data are read anew on each reflow, there is no self.data,
+        and with write_behind any queued edits are flushed before each read.
+    """
+    def __init__(self, h5filename, table_path=None, target=None, mode='r', bounds=None,
+                 time_name='time', flash_time_name='start', index_name='hdf_row_idx',
+                 chunk_rows=65536, write_behind=False):
+        self.target = target
+        self.write_behind = write_behind
+        self._pending_edits = []
+        self.version = 0
+        self.bounds = bounds
+        self.time_name = time_name
+        self.flash_time_name = flash_time_name
+        self.index_name = index_name
+        self.data = None
+        
+        self._open_tables(h5filename, table_path, mode)
+        sidecar = '{0}{1}.tindex.npz'.format(h5filename, self.table_path.replace('/', '_'))
+        self.time_index = TimeChunkIndex(self.table, time_name=time_name,
+                                         chunk_rows=chunk_rows, sidecar=sidecar)
+        if self.flash_table is not None:
+            extra = ('duration',) if ('duration' in self.flash_table.colnames) else ()
+            sidecar = '{0}{1}.tindex.npz'.format(h5filename, self.flash_table_path.replace('/', '_'))
+            self.flash_time_index = TimeChunkIndex(self.flash_table, time_name=flash_time_name,
+                                                   chunk_rows=chunk_rows, sidecar=sidecar,
+                                                   extra_fields=extra)
+        
+        get_exchange('SD_reflow_start').attach(self)
+
+    def open_for_writing(self):
+        super(HDF5LazyDataset, self).open_for_writing()
+        self.time_index.table = self.table
+        if self.flash_table is not None:
+            self.flash_time_index.table = self.flash_table
+
+    def time_limits(self):
+        if self.bounds is None:
+            return -np.inf, np.inf
+        return getattr(self.bounds, self.time_name)
+
+    def read_events(self, t_min, t_max):
+        """ Events with t_min <= time <= t_max, with their row numbers in index_name """
+        with hdf5_lock:
+            rows = self.time_index.rows(t_min, t_max)
+            events = self.table.read_coordinates(rows)
+        return append_fields(events, self.index_name, rows, usemask=False)
+
+    def read_flashes(self, t_min, t_max):
+        """ Flashes that start within t_min to t_max, or earlier by no more than
+            the longest flash duration.
+        """
+        t_min = t_min - self.flash_time_index.field_max.get('duration', 0.0)
+        with hdf5_lock:
+            rows = self.flash_time_index.rows(t_min, t_max)
+            return self.flash_table.read_coordinates(rows)
+
+    @property
+    def flash_data(self):
+        if self.flash_table is None:
+            raise AttributeError("No flash data")
+        return self.read_flashes(*self.time_limits())
+
+    @coroutine
+    def update(self, index_name="hdf_row_idx", field_names=None):
+        """ Write the values of field_names in the data received to the HDF5 file,
+            at the rows given by index_name.
+        """
+        while True:
+            a = (yield)
+            indices = a[index_name]
+            if field_names is None:
+                print("Did not update HDF5 file; field_names are required")
+                continue
+            for field_name in field_names:
+                self.update_h5(field_name, a[field_name], indices)
+            self.version += 1
+            get_exchange('B4D_dataset_updated').send((self, field_names, indices))
+
+    def send(self, msg):
+        """ SD_reflow_start messages are sent here """
+        self.flush_edits()
+        if self.target is not None:
+            self.target.send(self.read_events(*self.time_limits()))
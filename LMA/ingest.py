@@ -0,0 +1,246 @@
+""" Ingest of a LiveLMA websocket stream with asyncio, for Python 3.
+
+    The websocket is read by an asyncio event loop in its own thread, so neither
+    receiving nor decoding messages holds up the GUI. Decoded sources are
+    coalesced into micro-batches, at most one every batch_interval seconds, which
+    the GUI thread collects with take(). If the GUI falls behind, no more than
+    max_pending sources are held, and the rest are dropped or downsampled as
+    given by the overload policy. The connection is reopened after a failure,
+    waiting longer after each failed attempt.
+
+    Requires the websockets package, unless another connect function is given
+    (e.g., to test against a local stand-in server, see brawl4d.LMA.replay).
+
+Example
+-------
+
+from brawl4d.LMA.ingest import LiveIngest
+ingest = LiveIngest("ws://someuniversity.edu:port/path/to/stream")
+d = LiveLMADataset(ingest=ingest, figure=panels.figure, bounds=panels.bounds)
+
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+OVERLOAD_POLICIES = ('drop_oldest', 'drop_newest', 'downsample')
+
+
+def websocket_connect(host):
+    """ Default connect function: a websockets client connection to host """
+    import websockets
+    return websockets.connect(host, max_size=None)
+
+
+def lmatools_decoder():
+    """ Return a function that decodes a LiveLMA message into a list of
+        (header, data) pairs with the lmatools LiveLMAController.
+    """
+    from lmatools.live.liveLMA import LiveLMAController
+    decoded = []
+
+    class Collector(object):
+        def show(self, header, data):
+            decoded.append((header, data))
+
+    controller = LiveLMAController()
+    controller.views.append(Collector())
+
+    def decode(message):
+        del decoded[:]
+        controller.on_message(None, message)
+        return list(decoded)
+    return decode
+
+
+class LiveIngest(object):
+    """ Receive, decode, and batch the sources in a LiveLMA websocket stream.
+
+        decode turns one message into a list of (header, data) pairs, where data
+        is a named array of sources (lmatools_decoder() if None). connect(host)
+        returns an async context manager for a connection whose messages are
+        read with async for (websocket_connect if None).
+
+        Sources are handed over in batches of the sources decoded in the last
+        batch_interval seconds, or max_batch sources, whichever comes first.
+        Batches wait for take() until there are max_pending sources waiting. Then,
+        with overload='drop_oldest' the oldest waiting sources are dropped,
+        'drop_newest' drops the new batch, and 'downsample' keeps an evenly
+        spaced subset of all waiting sources. Dropped sources are counted in
+        dropped.
+
+        After the connection fails or closes, the next attempt is made after
+        reconnect_min seconds, doubling (with some jitter) for each failed attempt
+        up to reconnect_max. A successful connection resets the delay.
+    """
+    def __init__(self, host, decode=None, connect=None, batch_interval=0.25,
+                 max_batch=50000, max_pending=500000, overload='drop_oldest',
+                 reconnect_min=0.5, reconnect_max=30.0):
+        if overload not in OVERLOAD_POLICIES:
+            raise ValueError("overload must be one of {0}".format(OVERLOAD_POLICIES))
+        self.host = host
+        self.decode = decode if decode is not None else lmatools_decoder()
+        self.connect = connect if connect is not None else websocket_connect
+        self.batch_interval = batch_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.overload = overload
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+
+        self.messages = 0
+        self.received = 0
+        self.dropped = 0
+        self.batches = 0
+        self.connections = 0
+        self.decode_errors = 0
+        self.last_error = None
+        self.connected = False
+
+        # Decoded sources not yet batched, and batches waiting for take()
+        self._decoded = []
+        self._decoded_count = 0
+        self._ready = deque()
+        self._ready_count = 0
+        self._header = None
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._stopping = None
+
+    @property
+    def pending(self):
+        """ Number of sources waiting for take() """
+        return self._ready_count
+
+    def start(self):
+        """ Start the event loop in a daemon thread """
+        if self._thread is not None:
+            return
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        if self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._stopping.set)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._stopping = asyncio.Event()
+        try:
+            self._loop.run_until_complete(self.run())
+        finally:
+            self._loop.close()
+
+    async def run(self):
+        """ Receive and batch until stop() is called """
+        flusher = asyncio.ensure_future(self._flush_periodically())
+        receiver = asyncio.ensure_future(self._receive_forever())
+        await self._stopping.wait()
+        for task in (receiver, flusher):
+            task.cancel()
+        await asyncio.gather(receiver, flusher, return_exceptions=True)
+        self._flush()
+
+    async def _receive_forever(self):
+        delay = self.reconnect_min
+        while True:
+            try:
+                async with self.connect(self.host) as connection:
+                    self.connections += 1
+                    self.connected = True
+                    delay = self.reconnect_min
+                    async for message in connection:
+                        self._receive(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Any failure to connect or read, including a closed connection
+                self.last_error = e
+            self.connected = False
+            await asyncio.sleep(delay*random.uniform(0.8, 1.2))
+            delay = min(2*delay, self.reconnect_max)
+
+    def _receive(self, message):
+        self.messages += 1
+        try:
+            decoded = self.decode(message)
+        except Exception as e:
+            self.decode_errors += 1
+            self.last_error = e
+            return
+        for header, data in decoded:
+            if data.shape[0] == 0:
+                continue
+            self._header = header
+            self._decoded.append(data)
+            self._decoded_count += data.shape[0]
+            self.received += data.shape[0]
+        if self._decoded_count >= self.max_batch:
+            self._flush()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.batch_interval)
+            self._flush()
+
+    def _flush(self):
+        """ Move the decoded sources into a batch waiting for take() """
+        if self._decoded_count == 0:
+            return
+        batch = np.concatenate(self._decoded)
+        self._decoded, self._decoded_count = [], 0
+        with self._lock:
+            self._ready.append((self._header, batch))
+            self._ready_count += batch.shape[0]
+            self.batches += 1
+            if self._ready_count > self.max_pending:
+                self._shed_load()
+
+    def _shed_load(self):
+        excess = self._ready_count - self.max_pending
+        if self.overload == 'drop_newest':
+            header, batch = self._ready.pop()
+            self._ready_count -= batch.shape[0]
+            self.dropped += batch.shape[0]
+        elif self.overload == 'drop_oldest':
+            while excess > 0:
+                header, batch = self._ready.popleft()
+                if batch.shape[0] > excess:
+                    self._ready.appendleft((header, batch[excess:]))
+                    n = excess
+                else:
+                    n = batch.shape[0]
+                self._ready_count -= n
+                self.dropped += n
+                excess -= n
+        else:
+            header = self._ready[-1][0]
+            waiting = np.concatenate([batch for h, batch in self._ready])
+            keep = np.linspace(0, waiting.shape[0] - 1, self.max_pending).astype('i8')
+            self._ready.clear()
+            self._ready.append((header, waiting[keep]))
+            self._ready_count = keep.shape[0]
+            self.dropped += waiting.shape[0] - keep.shape[0]
+
+    def take(self):
+        """ Return (header, sources) for all waiting batches coalesced into one,
+            or None if there are none. Meant to be called from the GUI thread.
+        """
+        with self._lock:
+            if len(self._ready) == 0:
+                return None
+            batches = list(self._ready)
+            self._ready.clear()
+            self._ready_count = 0
+        header = batches[-1][0]
+        return header, np.concatenate([batch for h, batch in batches])
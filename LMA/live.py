@@ -22,8 +22,12 @@ from brawl4d.LMA.live import LiveLMADataset
 
 panels = B4D_startup(basedate=basedate)
 lma_ctrl = LMAController()
-d = LiveLMADataset(host=server)
-post_filter_brancher, post_transform_branch_to_scatter_artists = lma_ctrl.pipeline_for_dataset(d, panels)
+d = LiveLMADataset(host=server, bounds=panels.bounds)
+post_filter_brancher, scatter_ctrl = lma_ctrl.pipeline_for_dataset(d, panels)
+
+# Optionally, draw each new batch of sources without a reflow
+appender = LiveScatterAppender(panels, scatter_ctrl, bounds=(lma_ctrl.bounds,))
+d.append_target = appender.inlet
 
 panels.panels['tz'].axis((0, 86400, 0, 20))
 lma_ctrl.bounds.stations=(6,99)
@@ -33,27 +37,40 @@ This example does not automatically update the time in the plot, but is
 easily accomplished by tapping into matplotlib's timer events.
 
 """
+from __future__ import absolute_import
 
 from datetime import datetime
 import threading
-from collections import deque
+import time
 
 import numpy as np
 from numpy.lib.recfunctions import rename_fields
 
 from stormdrain.pubsub import get_exchange
+from stormdrain.pipeline import coroutine
 from lmatools.live.liveLMA import LiveLMAController, WebsocketClient
 
+from ..artists import BlittingFigureUpdater
+from ..filters import FusedBoundsFilter
+from .ringbuffer import ColumnarRingBuffer
+
     
 
 class LiveLMATimeController(object):
-    def __init__(self, panels, timespan=600.0, track_realtime=True, future_margin=.1, time_name='time'):
+    def __init__(self, panels, timespan=600.0, track_realtime=True, future_margin=.1, time_name='time',
+                 blit=False, monitor=None):
         """ Contol the real-time display aspects of a live display
             timespan is the total duration of the time axis in seconds
             future_margin is the fraction of total width of time to be displayed
             if track_realtime is set, the view will be updated every timespan * future_margin
+            if blit is set, the periodic draw only redraws the data artists unless
+            the view has scrolled; see BlittingFigureUpdater. The data artists are
+            then animated and left out of savefig, as for B4D_startup(blit=True).
+            monitor is a brawl4d.LMA.monitor.LiveMonitor that is told when each
+            draw ends and how long it took.
             """
         self.panels = panels
+        self.monitor = monitor
         self.time_name = time_name
         self.timespan = timespan
         self.future_margin = future_margin
@@ -66,6 +83,10 @@ class LiveLMATimeController(object):
         self.scroll_timer.interval = scroll_interval 
         self.scroll_timer.start()
         
+        self.figure_updater = None
+        if blit:
+            self.figure_updater = BlittingFigureUpdater(panels.figure)
+        
         self.draw_timer = panels.figure.canvas.new_timer()
         self.draw_timer.add_callback(self.draw)
         self.draw_timer.interval = 1.0*1000.0
@@ -76,7 +97,13 @@ class LiveLMATimeController(object):
             self.scroll_to_current()
 
     def draw(self):
-        self.panels.figure.canvas.draw()
+        t_start = time.time()
+        if self.figure_updater is not None:
+            self.figure_updater.draw()
+        else:
+            self.panels.figure.canvas.draw()
+        if self.monitor is not None:
+            self.monitor.drawn(time.time() - t_start)
     
     def scroll_to_current(self):
         if self.track_realtime:
@@ -88,10 +115,149 @@ class LiveLMATimeController(object):
             t_ax.set_xlim((t_min, t_max))
             
 
+class LiveScatterAppender(object):
+    """ Append new live sources to the scatter artists of scatter_ctrl without
+        sending the whole dataset through the pipeline.
+        
+        Batches sent to inlet are filtered by bounds (e.g., the LMA quality
+        criteria) and panels.bounds, projected, and appended to the offsets and
+        colors already shown, so the work for each batch is in proportion to its
+        size. Sources older than the start of the time axis are trimmed.
+        
+        The points shown are kept in a ColumnarRingBuffer along with the
+        offsets for each panel. Each reflow replaces them with the data sent
+        to the artists. If scatter_ctrl has other artist stages, such as
+        LevelOfDetailFilter or DensityRasterSwitch, the whole buffer is sent
+        through them after each batch instead, since what they show depends on
+        all of the points. Create the appender after adding those stages.
+        
+        If redraw is set, the figure is redrawn when idle after each batch. Leave
+        it off when a LiveLMATimeController is drawing periodically.
+    """
+    def __init__(self, panels, scatter_ctrl, bounds=(), names4d=('lon', 'lat', 'alt', 'time'),
+                 redraw=False):
+        self.panels = panels
+        self.scatter_ctrl = scatter_ctrl
+        self.time_name = names4d[3]
+        self.redraw = redraw
+        self.outlets = list(scatter_ctrl.artist_outlet_controllers)
+        self.buffer = None
+        self.target = None
+        scatter_ctrl.add_artist_stage(self, self.replace())
+        self.direct = (len(scatter_ctrl.artist_stages) == 1)
+        
+        final_filterer = FusedBoundsFilter(target=self.append(), bounds=(panels.bounds,)).filter()
+        projector = panels.cs.project_points(
+                            target=final_filterer, 
+                            x_coord='x', y_coord='y', z_coord='z', 
+                            lat_coord=names4d[1], lon_coord=names4d[0], alt_coord=names4d[2],
+                            distance_scale_factor=1.0e-3)
+        self.inlet = FusedBoundsFilter(target=projector, bounds=tuple(bounds) + (panels.bounds,),
+                                       exclude=('time',)).filter()
+    
+    def _offsets_name(self, i):
+        return '_offsets_{0}'.format(i)
+    
+    def _records(self, a):
+        """ The fields of a plus, if the artists are updated directly, the offsets
+            of each point in each panel
+        """
+        if self.buffer is None:
+            names = a.dtype.names
+            descr = [(n, a.dtype[n]) for n in names]
+            if self.direct:
+                descr += [(self._offsets_name(i), 'f8', (2,)) for i in range(len(self.outlets))]
+            dtype = np.dtype(descr)
+        else:
+            dtype = self.buffer.dtype
+        records = np.zeros(a.shape[0], dtype=dtype)
+        for name in a.dtype.names:
+            if name in dtype.names:
+                records[name] = a[name]
+        if not self.direct:
+            return records
+        for i, outlet in enumerate(self.outlets):
+            x_name, y_name = outlet.coords
+            offsets = records[self._offsets_name(i)]
+            offsets[:, 0] = a[x_name]
+            offsets[:, 1] = a[y_name]
+        return records
+    
+    def show(self):
+        data = self.buffer.view()
+        if not self.direct:
+            self.target.send(data)
+        else:
+            self.scatter_ctrl.last_data = data
+            c = np.asarray(data[self.scatter_ctrl.color_field])
+            clim = self.scatter_ctrl.color_limits(c)
+            for i, outlet in enumerate(self.outlets):
+                outlet.artist.set_offsets(data[self._offsets_name(i)])
+                outlet.artist.set_array(c)
+                if clim is not None:
+                    outlet.artist.set_clim(*clim)
+        if self.redraw:
+            self.panels.figure.canvas.draw_idle()
+    
+    @coroutine
+    def replace(self):
+        """ Artist stage that keeps the data sent to the artists on reflow """
+        while True:
+            a = (yield)
+            self.buffer = None
+            if a.shape[0] > 0:
+                records = self._records(a)
+                self.buffer = ColumnarRingBuffer(capacity=2*records.shape[0], time_name=self.time_name)
+                self.buffer.append(records)
+            if self.target is not None:
+                self.target.send(a)
+    
+    @coroutine
+    def append(self):
+        while True:
+            a = (yield)
+            if a.shape[0] == 0:
+                continue
+            records = self._records(a)
+            if self.buffer is None:
+                self.buffer = ColumnarRingBuffer(time_name=self.time_name)
+            self.buffer.append(records)
+            self.buffer.drop_before(self.panels.bounds.time[0])
+            self.show()
+
+
 class LiveLMADataset(object):
+    """ Sources from a LiveLMA websocket stream, kept in a ColumnarRingBuffer.
     
-    def __init__(self, target=None, host=None, basedate=None):
+        Sources older than max_age seconds (relative to the newest) or beyond the
+        newest max_count are dropped. If bounds is given, only the sources in its
+        time range are sent on reflow, as views of the buffer.
+        
+        If append_target is set (e.g., to LiveScatterAppender.inlet), each new
+        batch of sources is sent there alone instead of setting off a reflow of
+        the whole dataset.
+        
+        By default the stream is read by the lmatools WebsocketClient in a thread
+        of its own, and each message is shown as it arrives. Alternatively, pass
+        a brawl4d.LMA.ingest.LiveIngest (Python 3) as ingest, and the figure whose
+        canvas timer collects its batches every poll_interval seconds, so that
+        messages are batched and shown in the GUI thread.
+        
+        decode, if given, replaces the lmatools LiveLMA decoding of each message
+        by WebsocketClient, and returns a list of (header, data) pairs to show,
+        e.g., brawl4d.LMA.wire.decode_sources for a replay. monitor is a
+        brawl4d.LMA.monitor.LiveMonitor that is told about each batch received,
+        each time sources have been sent through the pipeline, and the depth of
+        the ingest queue.
+    """
+    def __init__(self, target=None, host=None, basedate=None, bounds=None,
+                 max_age=3600.0, max_count=None, capacity=65536, append_target=None,
+                 ingest=None, figure=None, poll_interval=0.1, decode=None, monitor=None):
         self.target = target
+        self.bounds = bounds
+        self.append_target = append_target
+        self.decode = decode
+        self.monitor = monitor
         get_exchange('SD_reflow_start').attach(self)
         
         self._t_offset = 0.0
@@ -99,34 +265,81 @@ class LiveLMADataset(object):
             # corrects for the meaning of time in the LMA analysis code
             self._t_offset += (basedate - datetime(1970, 1, 1)).total_seconds()           
             
-        self._dataq = deque([])
+        self.buffer = ColumnarRingBuffer(capacity=capacity, max_age=max_age, max_count=max_count)
+        # Sources are appended from the websocket thread
+        self._lock = threading.Lock()
         
-        self.livesource = LiveLMAController()
+        self.ingest = ingest
+        if ingest is not None:
+            self.poll_timer = figure.canvas.new_timer()
+            self.poll_timer.add_callback(self.poll)
+            self.poll_timer.interval = 1000.0*poll_interval
+            self.poll_timer.start()
+            ingest.start()
+            return
         
-        # New sources are sent as messages to self.show
-        self.livesource.views.append(self)
+        if decode is None:
+            self.livesource = LiveLMAController()
+            # New sources are sent as messages to self.show
+            self.livesource.views.append(self)
+            on_message = self.livesource.on_message
+        else:
+            on_message = self.on_message
         
         self._websocket_client = WebsocketClient(host=host)
         # client.connect(on_message=liveDataController.on_message)
         sock_thr = threading.Thread(target=self._websocket_client.connect, 
-                        kwargs={'on_message':self.livesource.on_message})
+                        kwargs={'on_message':on_message})
         sock_thr.daemon=True
         sock_thr.start()
         
+    def on_message(self, ws, message):
+        for header, newdata in self.decode(message):
+            self.show(header, newdata)
+    
+    def poll(self):
+        """ Show the sources waiting in self.ingest, if any """
+        if self.monitor is not None:
+            self.monitor.queued(self.ingest.pending, dropped=self.ingest.dropped)
+        batch = self.ingest.take()
+        if batch is not None:
+            self.show(*batch)
+        
     def show(self, header, newdata):
         # print("{0} new, {1} stations".format(header['num_sources'][0], header['num_stations'][0]))
         if newdata.shape[0] > 0:
+            if self.monitor is not None:
+                self.monitor.received(newdata['t'])
             newdata = rename_fields(newdata, {'t':'time'})
             newdata['time'] -= self._t_offset
-            self._dataq.append(newdata)
-            self.send("B4D_LMAnewsources_live")
+            with self._lock:
+                self.buffer.append(newdata)
+            if self.append_target is not None:
+                self.append_target.send(newdata)
+                if self.monitor is not None:
+                    self.monitor.reflowed()
+            else:
+                self.send("B4D_LMAnewsources_live")
+    
+    @property
+    def version(self):
+        return self.buffer.version
+    
+    @property
+    def data(self):
+        with self._lock:
+            return self.buffer.view()
     
     def send(self, msg):
         """ SD_reflow_data messages are sent here """
-        
-        # do we send the whole events table, or somehow dynamically determine that?
-        if len(self._dataq) > 0:
-            data = np.hstack([d for d in self._dataq if (d.shape[0] > 0)])
+        if len(self.buffer) > 0:
+            with self._lock:
+                if self.bounds is not None:
+                    data = self.buffer.window(*self.bounds.time)
+                else:
+                    data = self.buffer.view()
             # print "sending data to {0} with generator frame {1}".format(self.target, self.target.gi_frame)
             if self.target is not None:
                 self.target.send(data)
+                if self.monitor is not None:
+                    self.monitor.reflowed()
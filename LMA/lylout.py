@@ -0,0 +1,236 @@
+""" Fast reader for the ASCII LYLOUT_*.dat(.gz) files written by the LMA analysis
+    software.
+
+    The header is read line by line, and the data section is read in large blocks
+    straight from the (possibly gzipped) file. Data lines are fixed width, as given
+    by the "Data format:" header line, so each block can be viewed as a 2D array
+    of characters. Each numeric column is decoded from its columns of digits as a
+    fixed-point integer, and the station mask with lookup tables. Blocks that
+    aren't fixed width are parsed by numpy after finding the masks with a regular
+    expression.
+
+"""
+import gzip
+import re
+from datetime import datetime
+from multiprocessing import Pool
+
+import numpy as np
+
+# Names used for the columns of the "Data:" header line
+field_names = {'time (UT sec of day)':'time', 'lat':'lat', 'lon':'lon', 'alt(m)':'alt',
+               'reduced chi^2':'chi2', 'P(dBW)':'power', 'mask':'mask'}
+field_types = {'time':'f8', 'lat':'f8', 'lon':'f8', 'alt':'f4', 'chi2':'f4', 'power':'f4',
+               'mask':'u4'}
+
+# Value and number of bits set for each hex digit; all other characters are 0
+_hex_value = np.zeros(256, dtype='u4')
+_hex_bits = np.zeros(256, dtype='u1')
+for _c in '0123456789abcdefABCDEF':
+    _hex_value[ord(_c)] = int(_c, 16)
+    _hex_bits[ord(_c)] = bin(int(_c, 16)).count('1')
+
+
+def _open(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def read_header(f):
+    """ Read the header from file f, leaving f at the start of the data. Returns a
+        dict with the date (datetime at the start of the day), names, formats
+        ((width, decimals) for each column, or None if the format isn't given),
+        and number of events (None if not given).
+    """
+    header = {'date':None, 'names':None, 'formats':None, 'n_events':None}
+    while True:
+        line = f.readline()
+        if not line:
+            raise IOError("No data section found")
+        if not isinstance(line, str):
+            line = line.decode('ascii', 'replace')
+        line = line.strip()
+        if line.startswith('*** data ***'):
+            break
+        if line.startswith('Data start time:'):
+            start = datetime.strptime(line.split(':', 1)[1].strip(), '%m/%d/%y %H:%M:%S')
+            header['date'] = datetime(start.year, start.month, start.day)
+        elif line.startswith('Data format:'):
+            formats = re.findall(r'(\d+)(?:\.(\d+))?[a-z]', line.split(':', 1)[1])
+            header['formats'] = [(int(w), int(p or 0)) for w, p in formats]
+        elif line.startswith('Data:'):
+            cols = [c.strip() for c in line.split(':', 1)[1].split(',')]
+            header['names'] = [field_names.get(c, re.sub(r'\W', '', c)) for c in cols]
+        elif line.startswith('Number of events:'):
+            header['n_events'] = int(line.split(':', 1)[1])
+    return header
+
+
+def decode_mask(mask_chars):
+    """ Value and number of stations for hex station masks given as a 2D array of
+        characters (as uint8), one mask per row, right-justified.
+    """
+    value = np.zeros(mask_chars.shape[0], dtype='u4')
+    for i in range(mask_chars.shape[1]):
+        value *= 16
+        value += _hex_value[mask_chars[:, i]]
+    stations = _hex_bits[mask_chars].sum(axis=1, dtype='u1')
+    return value, stations
+
+
+def decode_fixed_point(chars, decimals):
+    """ Values of right-justified decimal numbers with the given number of decimals,
+        as a 2D array of characters (as uint8), one number per row. Returns None
+        if the decimal point isn't where expected in every row.
+    
+        The digits are accumulated as an exact integer, which is then divided by a
+        power of ten, so the result is the same as parsing the text.
+    """
+    width = chars.shape[1]
+    dot = width - decimals - 1
+    if (decimals > 0) and not (chars[:, dot] == ord('.')).all():
+        return None
+    # Spaces and signs wrap around to large values, and count as zero
+    digits = chars - np.uint8(ord('0'))
+    digits[digits > 9] = 0
+    value = np.zeros(chars.shape[0], dtype='i8')
+    for i in range(width):
+        if (decimals > 0) and (i == dot):
+            continue
+        value *= 10
+        value += digits[:, i]
+    negative = (chars == ord('-')).any(axis=1)
+    value[negative] *= -1
+    return value / (10.0**decimals)
+
+
+_mask_pattern = re.compile(br'0x[0-9a-fA-F]+')
+
+
+class LylOutDecoder(object):
+    """ Decode blocks of complete data lines into a named array """
+    def __init__(self, names, formats=None):
+        self.names = names
+        self.numeric = [n for n in names if n != 'mask']
+        descr = [(n, field_types.get(n, 'f8')) for n in names]
+        descr += [('stations', 'u1'), ('charge', 'i1')]
+        self.dtype = np.dtype(descr)
+        self.line_length = None
+        if formats is not None:
+            # Each field is followed by a space, except the last which is followed by
+            # the newline.
+            self.columns = {}
+            start = 0
+            for name, (width, decimals) in zip(names, formats):
+                self.columns[name] = (slice(start, start + width), decimals)
+                start += width + 1
+            self.line_length = start
+
+    def fixed_width(self, block):
+        """ 2D array of the characters in block, one row per line, or None if the
+            lines aren't fixed width
+        """
+        if (self.line_length is None) or (len(block) % self.line_length != 0):
+            return None
+        chars = np.frombuffer(block, dtype='u1').reshape(-1, self.line_length)
+        if not (chars[:, -1] == ord('\n')).all():
+            return None
+        return chars
+
+    def decode_fixed_width(self, chars):
+        a = np.zeros(chars.shape[0], dtype=self.dtype)
+        for name in self.names:
+            columns, decimals = self.columns[name]
+            if name == 'mask':
+                a['mask'], a['stations'] = decode_mask(chars[:, columns])
+                continue
+            values = decode_fixed_point(chars[:, columns], decimals)
+            if values is None:
+                return None
+            a[name] = values
+        return a
+
+    def decode(self, block):
+        chars = self.fixed_width(block)
+        if chars is not None:
+            a = self.decode_fixed_width(chars)
+            if a is not None:
+                return a
+        if 'mask' in self.names:
+            masks = np.array(_mask_pattern.findall(block), dtype='S')
+            n = masks.shape[0]
+            width = masks.dtype.itemsize
+            mask, stations = decode_mask(np.char.rjust(masks, width).view('u1').reshape(n, width))
+            text = _mask_pattern.sub(b' ', block)
+        else:
+            text = block
+        values = np.fromstring(text, dtype='f8', sep=' ').reshape(-1, len(self.numeric))
+        a = np.zeros(values.shape[0], dtype=self.dtype)
+        for i, name in enumerate(self.numeric):
+            a[name] = values[:, i]
+        if 'mask' in self.names:
+            a['mask'], a['stations'] = mask, stations
+        return a
+
+
+def read_lylout(filename, block_bytes=2**24):
+    """ Read a LYLOUT .dat or .dat.gz file. Returns the header (see read_header) and
+        a named array of the data, including the number of stations in the mask
+        and a charge field set to zero.
+
+        The file is decompressed and decoded block_bytes at a time, so the text is
+        never all in memory at once.
+    """
+    f = _open(filename)
+    try:
+        header = read_header(f)
+        decoder = LylOutDecoder(header['names'], header['formats'])
+        # Read a whole number of fixed-width records at a time when possible
+        if decoder.line_length is not None:
+            block_bytes -= block_bytes % decoder.line_length
+        parts = []
+        remainder = b''
+        while True:
+            chunk = f.read(block_bytes)
+            if not chunk:
+                break
+            chunk = remainder + chunk
+            last_newline = chunk.rfind(b'\n')
+            if last_newline < 0:
+                remainder = chunk
+                continue
+            remainder = chunk[last_newline+1:]
+            block = chunk[:last_newline+1]
+            parts.append(decoder.decode(block))
+        if remainder.strip():
+            parts.append(decoder.decode(remainder + b'\n'))
+    finally:
+        f.close()
+    if len(parts) == 0:
+        return header, np.zeros(0, dtype=decoder.dtype)
+    return header, np.concatenate(parts)
+
+
+def read_lylout_files(filenames, processes=None):
+    """ Read several LYLOUT files in parallel with a pool of processes (one per CPU
+        if processes is None), and concatenate the data in the order given. Times
+        are in seconds from the start of the day of the first file. Returns the
+        header of the first file and the data.
+    """
+    if len(filenames) == 1 or processes == 1:
+        results = [read_lylout(fn) for fn in filenames]
+    else:
+        pool = Pool(processes)
+        try:
+            results = pool.map(read_lylout, filenames)
+        finally:
+            pool.close()
+            pool.join()
+    first_header = results[0][0]
+    for header, data in results[1:]:
+        if (header['date'] is not None) and (first_header['date'] is not None):
+            days = (header['date'] - first_header['date']).days
+            if days != 0:
+                data['time'] += days*86400.0
+    return first_header, np.concatenate([data for header, data in results])
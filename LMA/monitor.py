@@ -0,0 +1,262 @@
+""" Measurements of the load on, and lag of, a live LMA display.
+
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# Bin edges for times in seconds, from 1 ms to 1000 s, about 12% wide
+TIME_EDGES = np.logspace(-3, 3, 121)
+# Bin edges for numbers of sources, from 1 to 10 million, about 33% wide
+COUNT_EDGES = np.logspace(0, 7, 57)
+
+
+class Histogram(object):
+    """ Counts of values in fixed bins, so that percentiles of a long stream of
+        values can be found in constant memory. Values beyond the first and last
+        edges are counted in extra bins at either end.
+    """
+    def __init__(self, edges=TIME_EDGES):
+        self.edges = np.asarray(edges, dtype='f8')
+        self.counts = np.zeros(self.edges.shape[0] + 1, dtype='i8')
+        self.n = 0
+        self.total = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values, weight=1):
+        """ Count each of values weight times """
+        values = np.atleast_1d(np.asarray(values, dtype='f8'))
+        if (values.shape[0] == 0) or (weight == 0):
+            return
+        bins = np.searchsorted(self.edges, values, side='right')
+        self.counts += weight*np.bincount(bins, minlength=self.counts.shape[0])
+        self.n += weight*values.shape[0]
+        self.total += weight*values.sum()
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    def mean(self):
+        if self.n == 0:
+            return np.nan
+        return self.total/self.n
+
+    def percentile(self, q):
+        """ Upper edge of the bin holding the q-th percentile (0 <= q <= 100),
+            which is within one bin width of the true value.
+        """
+        if self.n == 0:
+            return np.nan
+        rank = max(1, int(np.ceil(q/100.0*self.n)))
+        i = np.searchsorted(np.cumsum(self.counts), rank, side='left')
+        if i >= self.edges.shape[0]:
+            return self.max
+        return min(self.edges[i], self.max)
+
+
+class _PendingBatches(object):
+    """ (item, number of sources) for batches of sources waiting for a later
+        stage. No more than max_sources sources in max_batches batches are kept;
+        the oldest batches beyond that are dropped and their sources counted in
+        dropped.
+    """
+    def __init__(self, max_sources, max_batches):
+        self.max_sources = max_sources
+        self.max_batches = max_batches
+        self.batches = deque()
+        self.count = 0
+        self.dropped = 0
+
+    def append(self, item, n):
+        self.batches.append((item, n))
+        self.count += n
+        while (len(self.batches) > 1) and ((self.count > self.max_sources) or
+                                           (len(self.batches) > self.max_batches)):
+            old_item, old_n = self.batches.popleft()
+            self.count -= old_n
+            self.dropped += old_n
+
+    def take(self):
+        """ Remove and return all waiting batches """
+        batches = list(self.batches)
+        self.batches.clear()
+        self.count = 0
+        return batches
+
+
+class LiveMonitor(object):
+    """ Throughput, lag, and load of a live display. Pass the same monitor as the
+        monitor argument of LiveLMADataset and LiveLMATimeController, then call
+        report() or summary() at any time.
+
+        Each stage from the feed to the screen has a Histogram of its latency,
+        in seconds, for each source:
+        receipt_latency, from the time of the source (seconds since 1970, UTC)
+            to its receipt by LiveLMADataset.show,
+        reflow_latency, from receipt until the source has been sent through the
+            pipeline,
+        draw_latency, from then to the end of the next draw by
+            LiveLMATimeController, and
+        display_latency, from the time of the source to the end of that draw.
+        frame_time has the time taken by each draw, batch_size the number of
+        sources in each batch received, and queue_depth the number of sources
+        waiting for the GUI in LiveIngest each time it is polled. bottleneck()
+        names the slowest of the stages.
+
+        Sources wait for the later stages in memory. If nothing draws, no more
+        than max_pending sources (in max_pending_batches batches) wait for each
+        stage, and the oldest beyond that go unmeasured in that stage. They are
+        counted in unmeasured.
+
+        If log_interval is given, the summary is logged (to logger, by default
+        the brawl4d.LMA.live logger) at level INFO at most that often, when
+        sources are received or the figure is drawn.
+    """
+    stages = (('ingest', 'receipt_latency'), ('pipeline', 'reflow_latency'),
+              ('rendering', 'draw_latency'))
+
+    def __init__(self, clock=time.time, log_interval=None, logger=None, max_pending=1000000,
+                 max_pending_batches=10000):
+        self.clock = clock
+        self.log_interval = log_interval
+        if logger is None:
+            logger = logging.getLogger('brawl4d.LMA.live')
+        self.logger = logger
+        self.start = None
+        self.last = None
+        self.last_log = None
+        self.sources = 0
+        self.batches = 0
+        self.reflows = 0
+        self.frames = 0
+        self.dropped = 0
+        self.receipt_latency = Histogram()
+        self.reflow_latency = Histogram()
+        self.draw_latency = Histogram()
+        self.display_latency = Histogram()
+        self.frame_time = Histogram()
+        self.batch_size = Histogram(COUNT_EDGES)
+        self.queue_depth = Histogram(COUNT_EDGES)
+        # Receipt time of batches not yet through the pipeline, times batches
+        # came out of the pipeline, and source times, not yet drawn
+        self._unreflowed = _PendingBatches(max_pending, max_pending_batches)
+        self._reflowed = _PendingBatches(max_pending, max_pending_batches)
+        self._undrawn = _PendingBatches(max_pending, max_pending_batches)
+        # Sources are received in the websocket thread, unless there's a LiveIngest
+        self._lock = threading.Lock()
+
+    def received(self, source_times):
+        """ Record a batch of sources with times source_times """
+        source_times = np.array(source_times, dtype='f8')
+        n = source_times.shape[0]
+        with self._lock:
+            now = self.clock()
+            if self.start is None:
+                self.start = now
+            self.last = now
+            self.sources += n
+            self.batches += 1
+            self.receipt_latency.add(now - source_times)
+            self.batch_size.add(n)
+            self._unreflowed.append(now, n)
+            self._undrawn.append(source_times, n)
+        self._maybe_log()
+
+    def reflowed(self):
+        """ Record that the sources received so far have been sent through the
+            pipeline
+        """
+        with self._lock:
+            now = self.clock()
+            self.reflows += 1
+            n_reflowed = 0
+            for t_received, n in self._unreflowed.take():
+                self.reflow_latency.add(now - t_received, weight=n)
+                n_reflowed += n
+            if n_reflowed > 0:
+                self._reflowed.append(now, n_reflowed)
+
+    def queued(self, depth, dropped=None):
+        """ Record the number of sources waiting to be shown, and the total
+            number dropped so far, if known
+        """
+        with self._lock:
+            self.queue_depth.add(depth)
+            if dropped is not None:
+                self.dropped = dropped
+
+    def drawn(self, seconds):
+        """ Record a draw of the figure that took seconds """
+        with self._lock:
+            now = self.clock()
+            self.frames += 1
+            self.frame_time.add(seconds)
+            for t_reflowed, n in self._reflowed.take():
+                self.draw_latency.add(now - t_reflowed, weight=n)
+            for source_times, n in self._undrawn.take():
+                self.display_latency.add(now - source_times)
+        self._maybe_log()
+
+    @property
+    def unmeasured(self):
+        """ Number of stage latencies of sources that were not recorded """
+        return self._unreflowed.dropped + self._reflowed.dropped + self._undrawn.dropped
+
+    def sources_per_second(self):
+        if (self.start is None) or (self.last <= self.start):
+            return 0.0
+        return self.sources/(self.last - self.start)
+
+    def bottleneck(self, q=90):
+        """ Name of the stage (ingest, pipeline, or rendering) with the largest
+            q-th percentile latency, or None before anything is drawn.
+        """
+        latencies = [(getattr(self, name).percentile(q), stage) for stage, name in self.stages
+                     if getattr(self, name).n > 0]
+        if len(latencies) < len(self.stages):
+            return None
+        return max(latencies)[1]
+
+    def report(self, percentiles=(50, 90, 99)):
+        """ Dictionary of the counts, the sustained rate of sources, the given
+            percentiles and maximum of each histogram, and the bottleneck
+        """
+        with self._lock:
+            report = {'sources':self.sources, 'batches':self.batches, 'reflows':self.reflows,
+                      'frames':self.frames, 'dropped':self.dropped, 'unmeasured':self.unmeasured,
+                      'sources_per_second':self.sources_per_second(),
+                      'bottleneck':self.bottleneck()}
+            for name in ('receipt_latency', 'reflow_latency', 'draw_latency', 'display_latency',
+                         'frame_time', 'batch_size', 'queue_depth'):
+                histogram = getattr(self, name)
+                report[name] = dict(('p{0}'.format(q), histogram.percentile(q)) for q in percentiles)
+                report[name]['max'] = histogram.max if histogram.n > 0 else np.nan
+        return report
+
+    def summary(self):
+        r = self.report()
+        template = ("{sources} sources ({rate:.0f}/s) in {batches} batches, {dropped} dropped, "
+                    "{frames} frames, {unmeasured} unmeasured. Latency p50/p99: "
+                    "receipt {rl[p50]:.3f}/{rl[p99]:.3f} s, reflow {fl[p50]:.3f}/{fl[p99]:.3f} s, "
+                    "draw {dl[p50]:.3f}/{dl[p99]:.3f} s, "
+                    "display {sl[p50]:.3f}/{sl[p99]:.3f} s. Frame time p50/max "
+                    "{ft[p50]:.3f}/{ft[max]:.3f} s. Batch size p50/max {bs[p50]:.0f}/{bs[max]:.0f}, "
+                    "queue depth p50/max {qd[p50]:.0f}/{qd[max]:.0f}. Bottleneck: {bottleneck}")
+        return template.format(sources=r['sources'], rate=r['sources_per_second'],
+                               batches=r['batches'], dropped=r['dropped'], frames=r['frames'],
+                               unmeasured=r['unmeasured'],
+                               rl=r['receipt_latency'], fl=r['reflow_latency'],
+                               dl=r['draw_latency'], sl=r['display_latency'],
+                               ft=r['frame_time'], bs=r['batch_size'], qd=r['queue_depth'],
+                               bottleneck=r['bottleneck'])
+
+    def _maybe_log(self):
+        if self.log_interval is None:
+            return
+        now = self.clock()
+        if (self.last_log is None) or (now - self.last_log >= self.log_interval):
+            self.last_log = now
+            self.logger.info(self.summary())
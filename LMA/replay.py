@@ -0,0 +1,145 @@
+""" Replay archived LMA sources over a local websocket, at a multiple of real
+    time, to load test the live display. Requires Python 3 and the websockets
+    package, and PyTables for HDF5 files.
+
+    The sources are read from LYLOUT .dat(.gz) files or LMA HDF5 files, and
+    sent in time order in messages encoded by brawl4d.LMA.wire, one message
+    every interval seconds with the sources that have come due. Each client
+    gets the whole replay from the start. Source times are shifted so that the
+    first source is now and compressed by speed, so they can be compared to the
+    clock of the display.
+
+    From the command line:
+
+    python3 -m brawl4d.LMA.replay --speed 10 --port 8765 LYLOUT_*.dat.gz
+
+    Then, in the display session, read the replay with decode_sources, send it
+    through the usual pipeline, and measure it with a LiveMonitor:
+
+    from brawl4d.LMA.ingest import LiveIngest
+    from brawl4d.LMA.wire import decode_sources
+    from brawl4d.LMA.monitor import LiveMonitor
+    monitor = LiveMonitor()
+    ingest = LiveIngest("ws://localhost:8765", decode=decode_sources)
+    d = LiveLMADataset(ingest=ingest, figure=panels.figure, monitor=monitor,
+                       basedate=basedate, bounds=panels.bounds)
+    post_filter_brancher, scatter_ctrl = lma_ctrl.pipeline_for_dataset(d, panels)
+    time_ctrl = LiveLMATimeController(panels, monitor=monitor)
+    ...
+    print(monitor.summary())
+
+    The server prints its own sustained rate and how far behind schedule it is
+    sending, which grows when the display can't keep up with the stream.
+
+"""
+import argparse
+import asyncio
+import time
+
+import numpy as np
+from numpy.lib.recfunctions import rename_fields
+
+from brawl4d.LMA.lylout import read_lylout_files
+from brawl4d.LMA.monitor import Histogram
+from brawl4d.LMA.wire import encode_sources
+
+
+def read_hdf5_sources(filename):
+    import tables
+    from brawl4d.LMA.hdf5_lma import events_table_path
+    h5 = tables.open_file(filename, mode='r')
+    try:
+        return h5.get_node(events_table_path(h5)).read()
+    finally:
+        h5.close()
+
+
+def read_sources(paths):
+    """ Sources in paths (all .dat(.gz) or all HDF5 files) as a named array
+        sorted by time
+    """
+    if all(p.endswith('.h5') for p in paths):
+        data = np.concatenate([read_hdf5_sources(p) for p in sorted(paths)])
+    else:
+        header, data = read_lylout_files(sorted(paths))
+    return data[np.argsort(data['time'], kind='mergesort')]
+
+
+class ReplayServer(object):
+    """ Serve data (a named array with time in seconds, in time order) to each
+        websocket client at speed times real time. Sources are sent with the
+        LiveLMA field name t for their (shifted) time.
+
+        sent counts the sources sent to all clients, and lag is a Histogram of
+        how late each message was sent compared to the time of its last source.
+    """
+    def __init__(self, data, speed=1.0, interval=0.1):
+        self.data = data
+        self.speed = speed
+        self.interval = interval
+        self.sent = 0
+        self.clients = 0
+        self.start = None
+        self.lag = Histogram()
+
+    async def handler(self, websocket, path=None):
+        self.clients += 1
+        times = self.data['time']
+        t0 = times[0]
+        wall0 = time.time()
+        if self.start is None:
+            self.start = wall0
+        i, n = 0, times.shape[0]
+        while i < n:
+            now = time.time()
+            j = np.searchsorted(times, t0 + (now - wall0)*self.speed, side='right')
+            if j > i:
+                batch = rename_fields(self.data[i:j].copy(), {'time':'t'})
+                batch['t'] = wall0 + (times[i:j] - t0)/self.speed
+                await websocket.send(encode_sources(batch, {'speed':self.speed}))
+                self.lag.add(time.time() - batch['t'][-1])
+                self.sent += j - i
+                i = j
+            await asyncio.sleep(self.interval)
+
+    def sources_per_second(self):
+        if self.start is None:
+            return 0.0
+        return self.sent/max(time.time() - self.start, 1e-9)
+
+    def summary(self):
+        return ("{0} sources sent to {1} clients ({2:.0f}/s). "
+                "Send lag p50/p99/max = {3:.3f}/{4:.3f}/{5:.3f} s").format(
+                    self.sent, self.clients, self.sources_per_second(),
+                    self.lag.percentile(50), self.lag.percentile(99),
+                    self.lag.max if self.lag.n > 0 else np.nan)
+
+    async def serve(self, host='localhost', port=8765, report_interval=10.0):
+        import websockets
+        async with websockets.serve(self.handler, host, port, max_size=None):
+            while True:
+                await asyncio.sleep(report_interval)
+                print(self.summary())
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('files', nargs='+', help="LYLOUT .dat(.gz) or LMA HDF5 files")
+    parser.add_argument('--speed', type=float, default=1.0, help="multiple of real time")
+    parser.add_argument('--interval', type=float, default=0.1, help="seconds between messages")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--report-interval', type=float, default=10.0)
+    args = parser.parse_args(args)
+    data = read_sources(args.files)
+    print("Replaying {0} sources at {1}x on ws://{2}:{3}".format(
+          data.shape[0], args.speed, args.host, args.port))
+    server = ReplayServer(data, speed=args.speed, interval=args.interval)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.report_interval))
+    except KeyboardInterrupt:
+        print(server.summary())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+""" Bounded columnar buffer for a stream of LMA sources.
+
+"""
+from __future__ import absolute_import
+
+import numpy as np
+
+from .sidecar import ColumnarData
+
+
+class ColumnarRingBuffer(object):
+    """ Preallocated storage for a stream of named array batches, one array per
+        field, holding the sources from row start to stop.
+
+        Batches are appended at stop. When there isn't room at the end, the
+        sources being kept are copied to the front of new arrays, twice as large
+        if more than half full, so appends are amortized O(1). Sources are
+        retained by count (the newest max_count) and by age (those no more than
+        max_age seconds older than the newest); older ones are dropped from the
+        front, or on arrival, and counted in dropped.
+
+        The arrays are never written behind stop, and are replaced rather than
+        overwritten when compacted, so the views returned by view() and window()
+        are never changed by later appends. Each batch is sorted by time on the
+        way in. As long as batches arrive in time order, as from a live stream,
+        window() is a binary search and returns views; otherwise the rows are
+        gathered into a new array.
+    """
+    def __init__(self, capacity=65536, max_age=None, max_count=None, time_name='time'):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.max_count = max_count
+        self.time_name = time_name
+        self.names = None
+        self.dtype = None
+        self.columns = None
+        self.start = 0
+        self.stop = 0
+        # Rows before this one may be out of time order
+        self._unsorted_stop = 0
+        self.newest = -np.inf
+        self.appended = 0
+        self.dropped = 0
+        self.version = 0
+
+    def __len__(self):
+        return self.stop - self.start
+
+    @property
+    def nbytes(self):
+        """ Bytes allocated for the buffer """
+        if self.columns is None:
+            return 0
+        return sum(c.nbytes for c in self.columns.values())
+
+    @property
+    def used_bytes(self):
+        """ Bytes used by the sources in the buffer """
+        if self.columns is None:
+            return 0
+        return len(self)*sum(c.itemsize for c in self.columns.values())
+
+    def _allocate(self, dtype, capacity):
+        return dict((name, np.empty(capacity, dtype=dtype[name])) for name in self.names)
+
+    def _make_room(self, n):
+        needed = len(self) + n
+        capacity = self.capacity
+        if needed > capacity//2:
+            capacity = max(2*capacity, 2*needed)
+        columns = self._allocate(self.dtype, capacity)
+        for name in self.names:
+            columns[name][:len(self)] = self.columns[name][self.start:self.stop]
+        self._unsorted_stop = max(0, self._unsorted_stop - self.start)
+        self.stop -= self.start
+        self.start = 0
+        self.columns = columns
+        self.capacity = capacity
+
+    def append(self, data):
+        """ Append the named array data, which must have the fields of the first
+            batch appended, then apply the retention policy.
+        """
+        n = data.shape[0]
+        if n == 0:
+            return
+        if self.columns is None:
+            self.names = data.dtype.names
+            self.dtype = data.dtype
+            self.capacity = max(self.capacity, n)
+            self.columns = self._allocate(self.dtype, self.capacity)
+        t = data[self.time_name]
+        if self.max_age is not None:
+            # Late arrivals that are already too old are never stored
+            recent = (t >= self.newest - self.max_age)
+            if not recent.all():
+                self.dropped += n - np.count_nonzero(recent)
+                data, t = data[recent], t[recent]
+                n = data.shape[0]
+                if n == 0:
+                    return
+        if (n > 1) and (t[1:] < t[:-1]).any():
+            data = data[np.argsort(t, kind='mergesort')]
+            t = data[self.time_name]
+        if self.stop + n > self.capacity:
+            self._make_room(n)
+        if (len(self) > 0) and (t[0] < self.columns[self.time_name][self.stop-1]):
+            self._unsorted_stop = self.stop + n
+        for name in self.names:
+            self.columns[name][self.stop:self.stop+n] = data[name]
+        self.stop += n
+        self.newest = max(self.newest, t[-1])
+        self.appended += n
+        self.retain()
+        self.version += 1
+
+    def retain(self):
+        """ Drop sources beyond max_count or older than max_age """
+        if (self.max_count is not None) and (len(self) > self.max_count):
+            self.dropped += len(self) - self.max_count
+            self.start = self.stop - self.max_count
+        if self.max_age is not None:
+            self.drop_before(self.newest - self.max_age)
+
+    def drop_before(self, t_min):
+        """ Drop sources from the front of the buffer up to the first one with
+            time >= t_min. Returns the number dropped.
+        """
+        if len(self) == 0:
+            return 0
+        t = self.columns[self.time_name][self.start:self.stop]
+        if self.time_sorted():
+            old = np.searchsorted(t, t_min, side='left')
+        else:
+            recent = (t >= t_min)
+            old = np.argmax(recent) if recent.any() else len(self)
+        self.dropped += old
+        self.start += old
+        return old
+
+    def time_sorted(self):
+        return self.start >= self._unsorted_stop
+
+    def view(self):
+        """ All sources in the buffer, as a ColumnarData of views """
+        if self.columns is None:
+            return None
+        columns = dict((name, self.columns[name][self.start:self.stop]) for name in self.names)
+        return ColumnarData(columns, names=self.names)
+
+    def window(self, t_min, t_max):
+        """ Sources with t_min <= time <= t_max """
+        data = self.view()
+        if data is None:
+            return None
+        t = data[self.time_name]
+        if self.time_sorted():
+            i0 = np.searchsorted(t, t_min, side='left')
+            i1 = np.searchsorted(t, t_max, side='right')
+            columns = dict((name, data[name][i0:i1]) for name in self.names)
+            return ColumnarData(columns, names=self.names)
+        return data[np.flatnonzero((t >= t_min) & (t <= t_max))]
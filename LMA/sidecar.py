@@ -0,0 +1,139 @@
+""" Columnar sidecar cache for LMA data files.
+
+    Parsing a .dat.gz file or reading an HDF5 table is slow compared to mapping
+    arrays that are already in memory layout. The first time a file is loaded
+    with a sidecar, each field is saved as a native-endian .npy file in a
+    directory next to the source, along with a stable time-sort permutation.
+    Later loads memory-map those arrays, so startup takes only as long as
+    opening a few files, and pages are read (and shared by the OS among all
+    processes using the same file) only as they are used.
+
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+SIDECAR_VERSION = 1
+
+
+def sidecar_dir(source):
+    return source + '.columns'
+
+
+def _source_stamp(source):
+    st = os.stat(source)
+    return st.st_size, st.st_mtime
+
+
+class ColumnarData(object):
+    """ Named array data stored as one array per field, e.g., memory-mapped
+        columns. Indexing by field name returns the column; indexing rows by
+        slice, boolean mask, or index array gathers those rows of all fields into
+        a new named array, so this can stand in for a numpy named array as the
+        data of a dataset.
+
+        time_order, if given, is a stable permutation that sorts the rows by time,
+        and is used by TimeIndex.
+    """
+    def __init__(self, columns, names=None, time_order=None):
+        if names is None:
+            names = sorted(columns.keys())
+        self.names = tuple(names)
+        self.columns = columns
+        self.time_order = time_order
+
+    def __len__(self):
+        return self.columns[self.names[0]].shape[0]
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    @property
+    def size(self):
+        return len(self)
+
+    @property
+    def dtype(self):
+        return np.dtype([(n, self.columns[n].dtype) for n in self.names])
+
+    @property
+    def nbytes(self):
+        return sum(self.columns[n].nbytes for n in self.names)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.columns[key]
+        rows = self.columns[self.names[0]][key]
+        a = np.empty(np.shape(rows), dtype=self.dtype)
+        for name in self.names:
+            a[name] = self.columns[name][key]
+        return a
+
+    def __setitem__(self, key, value):
+        if isinstance(key, str):
+            self.columns[key][...] = value
+        else:
+            for name in self.names:
+                self.columns[name][key] = value[name]
+
+
+def write_sidecar(source, data, time_name='time'):
+    """ Save each field of the named array data, and the time-sort permutation,
+        as .npy files in the sidecar directory for source. The files are written
+        to a temporary directory which is then renamed, so that other processes
+        never see a partial sidecar. Returns False if the sidecar couldn't be
+        written.
+    """
+    size, mtime = _source_stamp(source)
+    path = sidecar_dir(source)
+    tmp = None
+    try:
+        tmp = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(os.path.abspath(path)))
+        names = data.dtype.names
+        for name in names:
+            column = data[name]
+            column = column.astype(column.dtype.newbyteorder('='), copy=False)
+            np.save(os.path.join(tmp, name + '.npy'), column)
+        if time_name in names:
+            order = np.argsort(data[time_name], kind='mergesort')
+            np.save(os.path.join(tmp, '_time_order.npy'), order)
+        np.savez(os.path.join(tmp, '_meta.npz'), version=SIDECAR_VERSION,
+                 size=size, mtime=mtime, nrows=data.shape[0], names=np.array(names))
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        # e.g., a read-only directory, or another process put its sidecar in place first
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+        return False
+    return True
+
+
+def load_sidecar(source, mmap_mode='r'):
+    """ Return a ColumnarData with memory-mapped columns from the sidecar for
+        source, or None if there is no sidecar or the source has changed since it
+        was written. Use mmap_mode='c' to allow changes to the data in memory
+        that are not written back to the sidecar.
+    """
+    path = sidecar_dir(source)
+    meta_file = os.path.join(path, '_meta.npz')
+    if not os.path.exists(meta_file):
+        return None
+    meta = np.load(meta_file)
+    size, mtime = _source_stamp(source)
+    if ((int(meta['version']) != SIDECAR_VERSION) or (int(meta['size']) != size) or
+            (float(meta['mtime']) != mtime)):
+        return None
+    names = [str(n) for n in meta['names']]
+    columns = dict((n, np.load(os.path.join(path, n + '.npy'), mmap_mode=mmap_mode))
+                   for n in names)
+    order_file = os.path.join(path, '_time_order.npy')
+    time_order = None
+    if os.path.exists(order_file):
+        time_order = np.load(order_file, mmap_mode='r')
+    return ColumnarData(columns, names=names, time_order=time_order)
+
@@ -176,8 +176,8 @@ class LMAwidgetController:
 		self.panels.lasso()
 
 	def change_color_field(self, name, the_value):
+		# Recolors the points already shown; no need for a reflow.
 		self.scatter_ctrl.color_field = the_value
-		redraw(self.panels)
 
 	def run_animation_button(self, anim):
 		n_seconds = self.animation_time_widget.value
@@ -0,0 +1,50 @@
+""" A self-describing message format for streams of LMA sources.
+
+    Each message is one binary websocket frame: a 4-byte little-endian length n,
+    n bytes of UTF-8 JSON header, and then the sources as packed little-endian
+    records. The header gives the record layout in dtype (a numpy descr) and the
+    number of sources in num_sources, along with anything else the sender adds.
+
+    This is the format sent by brawl4d.LMA.replay. It is not the lmatools
+    LiveLMA format; pass decode_sources as the decode argument of LiveLMADataset
+    or LiveIngest to read it.
+
+"""
+import json
+import struct
+
+import numpy as np
+
+
+def encode_sources(data, header=None):
+    """ Message for the named array of sources data, with the items in header
+        added to the JSON header.
+    """
+    header = dict(header or {})
+    descr = [(name, data.dtype[name].newbyteorder('<')) for name in data.dtype.names]
+    data = np.ascontiguousarray(data.astype(descr))
+    header['dtype'] = data.dtype.descr
+    header['num_sources'] = data.shape[0]
+    text = json.dumps(header).encode('utf-8')
+    return struct.pack('<I', len(text)) + text + data.tobytes()
+
+
+def _dtype_from_descr(descr):
+    fields = []
+    for field in descr:
+        item = (str(field[0]), str(field[1]))
+        if len(field) > 2:
+            item += (tuple(field[2]),)
+        fields.append(item)
+    return np.dtype(fields)
+
+
+def decode_sources(message):
+    """ Decode a message into a list of one (header, data) pair. data is a new,
+        writeable named array.
+    """
+    n, = struct.unpack('<I', message[:4])
+    header = json.loads(message[4:4+n].decode('utf-8'))
+    dtype = _dtype_from_descr(header['dtype'])
+    data = np.frombuffer(message, dtype=dtype, offset=4+n).copy()
+    return [(header, data)]
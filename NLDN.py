@@ -1,3 +1,5 @@
+from __future__ import absolute_import, print_function
+
 import numpy as np
 from numpy.lib.recfunctions import append_fields
 
@@ -8,6 +10,8 @@ from stormdrain.pipeline import Branchpoint, coroutine, ItemModifier
 from stormdrain.support.matplotlib.artistupdaters import PanelsScatterController
 from stormdrain.support.matplotlib.markers import filled_plus
 
+from .filters import TimeWindowFilter
+
 from lmatools.NLDN import NLDNdataFile
 
 
@@ -61,14 +65,15 @@ class TimedGroundMarkerController(object):
         transform_mapping = {'z':('alt', (lambda v: (v[0]*1.0e3 - 1.0e3, v[1]*1.0e3 + 1.0e3)) ) }
         # make the target in the line below quality_filter to add additional data-dependent
         # filtering.
-        bound_filter = BoundsFilter(target=brancher, bounds=panels.bounds, 
-                                    restrict_to=('time'), transform_mapping=transform_mapping)
+        bound_filter = TimeWindowFilter(target=brancher, bounds=panels.bounds, 
+                                    transform_mapping=transform_mapping)
         filterer = bound_filter.filter()
         # Adjust the height in response to bounds changes, so that the markers stay near
         # the bottom axis in a time-height view
         height_control = GroundMarkerHeightController(target=filterer, alt_name='alt')
         height_adjuster = height_control.adjust_height()
         d.target = height_adjuster
+        panels.add_reflow_receiver(d)
         
         # Set up brancher -> coordinate transform -> final_filter -> mutli-axis scatter updater
         scatter_ctrl = PanelsScatterController(
@@ -78,7 +83,7 @@ class TimedGroundMarkerController(object):
         
         scatter_outlet_broadcaster = scatter_ctrl.branchpoint
         scatter_updater = scatter_outlet_broadcaster.broadcast() 
-        final_bound_filter = BoundsFilter(target=scatter_updater, bounds=panels.bounds)
+        final_bound_filter = BoundsFilter(target=panels.gui_stage(scatter_updater), bounds=panels.bounds)
         final_filterer = final_bound_filter.filter()
         cs_transformer = panels.cs.project_points(
                             target=final_filterer, 
@@ -105,7 +110,7 @@ class NLDNController(TimedGroundMarkerController):
         def print_CG():
             while True:
                 a=(yield)
-                print "NLDN points: {0}".format(a)
+                print("NLDN points: {0}".format(a))
         CGprinter = print_CG()
     
         neg_ctrl = nneg[-1]
@@ -0,0 +1,384 @@
+""" Extensions to the stormdrain artist updaters for large datasets.
+
+"""
+import numpy as np
+
+from stormdrain.pipeline import Branchpoint, coroutine
+from stormdrain.support.matplotlib.artistupdaters import PanelsScatterController as BasePanelsScatterController
+
+
+class PanelsScatterController(BasePanelsScatterController):
+    """ Same as the stormdrain PanelsScatterController, but with a chain of stages
+        between self.branchpoint and the scatter artists. Anything attached to
+        self.branchpoint still sees the full selection, while the artists see
+        the result of the stages, e.g., a decimated selection.
+        
+        The data last sent to the artists are kept in last_data. Setting
+        color_field or default_color_bounds, or calling set_color_bounds, recolors
+        the existing artists from last_data without a reflow, and calls the
+        recolor method of any stage that has one.
+    """
+    def __init__(self, *args, **kwargs):
+        self.last_data = None
+        super(PanelsScatterController, self).__init__(*args, **kwargs)
+        # At this point the only targets are the artist outlets.
+        artist_targets = list(self.branchpoint.targets)
+        for artist_target in artist_targets:
+            self.branchpoint.targets.remove(artist_target)
+        self.artist_branchpoint = Branchpoint(artist_targets)
+        self._artist_head = self._remember(self.artist_branchpoint.broadcast())
+        self.branchpoint.targets.add(self._artist_head)
+        self.artist_stages = []
+
+    @coroutine
+    def _remember(self, target):
+        while True:
+            a = (yield)
+            self.last_data = a
+            target.send(a)
+
+    @property
+    def color_field(self):
+        return self._color_field
+
+    @color_field.setter
+    def color_field(self, name):
+        self._color_field = name
+        self.recolor()
+
+    @property
+    def default_color_bounds(self):
+        return self._default_color_bounds
+
+    @default_color_bounds.setter
+    def default_color_bounds(self, bounds):
+        self._default_color_bounds = bounds
+        self.recolor()
+
+    def set_color_bounds(self, **limits):
+        """ Set limits (e.g., power=(-10, 40)) on default_color_bounds and recolor """
+        for name, lim in limits.items():
+            setattr(self.default_color_bounds, name, lim)
+        self.recolor()
+
+    def color_limits(self, c):
+        """ Color limits for the values c of color_field: the default color bounds
+            for the field if there are any, or else the range of c.
+        """
+        bounds = getattr(self, '_default_color_bounds', None)
+        if bounds is not None:
+            limits = dict(bounds.limits())
+            if self._color_field in limits:
+                v_min, v_max = limits[self._color_field]
+                if np.isfinite(v_min) and np.isfinite(v_max):
+                    return v_min, v_max
+        if c.shape[0] == 0:
+            return None
+        return c.min(), c.max()
+
+    def recolor(self):
+        """ Update the colors of the artists from last_data and the current color
+            field and color bounds, without moving any points.
+        """
+        if not hasattr(self, 'artist_stages'):
+            # Called by the stormdrain __init__, before there are any artists
+            return
+        for outlet in self.artist_outlet_controllers:
+            if hasattr(outlet, 'color_field'):
+                outlet.color_field = self._color_field
+        for stage in self.artist_stages:
+            if hasattr(stage, 'recolor'):
+                stage.recolor()
+        a = self.last_data
+        if a is not None:
+            c = np.asarray(a[self._color_field])
+            clim = self.color_limits(c)
+            for outlet in self.artist_outlet_controllers:
+                outlet.artist.set_array(c)
+                if clim is not None:
+                    outlet.artist.set_clim(*clim)
+        self.panels.figure.canvas.draw_idle()
+
+    def add_artist_stage(self, stage, inlet):
+        """ Insert stage just after self.branchpoint, ahead of any other stages.
+            stage must send its results to stage.target, which is set here,
+            and inlet is the running coroutine that receives data for stage.
+        """
+        stage.target = self._artist_head
+        self.branchpoint.targets.remove(self._artist_head)
+        self.branchpoint.targets.add(inlet)
+        self._artist_head = inlet
+        self.artist_stages.insert(0, stage)
+
+
+def pixel_bins(panels, ax, a, field_map=None):
+    """ Index of the pixel of ax in which each point in a falls, using the coordinates
+        plotted on ax as given by panels.ax_specs. Points outside the axes are
+        assigned to the nearest edge pixel. field_map optionally maps the coordinate
+        names in panels.ax_specs to other field names in a.
+    """
+    x_name, y_name = panels.ax_specs[ax]
+    if field_map is not None:
+        x_name, y_name = field_map.get(x_name, x_name), field_map.get(y_name, y_name)
+    x0, x1 = ax.get_xlim()
+    y0, y1 = ax.get_ylim()
+    nx = max(1, int(np.ceil(ax.bbox.width)))
+    ny = max(1, int(np.ceil(ax.bbox.height)))
+    ix = ((a[x_name] - x0) * (nx / (x1 - x0))).astype('i8')
+    iy = ((a[y_name] - y0) * (ny / (y1 - y0))).astype('i8')
+    np.clip(ix, 0, nx - 1, out=ix)
+    np.clip(iy, 0, ny - 1, out=iy)
+    return ix * ny + iy, (nx, ny)
+
+
+class LevelOfDetailFilter(object):
+    """ Reduce the number of points sent to the scatter artists so that no more than
+        max_per_pixel points fall in any pixel of any of the panels. Points are kept
+        in time order, so the earliest points in each pixel win, and the result is
+        the same every time for the same data and view.
+
+        A point is kept if it is kept in any panel, so each panel has full coverage
+        of the pixels with data. When there are no more than min_points points, or
+        when the view is zoomed in enough that there's little overlap, all points
+        are passed through.
+        
+        field_map is passed to pixel_bins, and is used to find the time field, too.
+    """
+    def __init__(self, panels, target=None, max_per_pixel=1, min_points=100000, field_map=None):
+        self.panels = panels
+        self.target = target
+        self.max_per_pixel = max_per_pixel
+        self.min_points = min_points
+        if field_map is None:
+            field_map = {}
+        self.field_map = field_map
+
+    def _first_in_each_bin(self, keys, n_bins):
+        """ Positions of the first max_per_pixel entries of each value in keys,
+            which are between 0 and n_bins. Each pass picks the first remaining
+            entry of each value, the smallest position found by np.minimum.at,
+            so no sort is needed.
+        """
+        chosen = []
+        remaining = np.arange(keys.shape[0])
+        for i in range(self.max_per_pixel):
+            n = keys.shape[0]
+            if n == 0:
+                break
+            first = np.empty(n_bins, dtype='i8')
+            first.fill(n)
+            np.minimum.at(first, keys, np.arange(n))
+            picked = first[first < n]
+            chosen.append(remaining[picked])
+            if i + 1 < self.max_per_pixel:
+                unpicked = np.ones(keys.shape[0], dtype=bool)
+                unpicked[picked] = False
+                remaining, keys = remaining[unpicked], keys[unpicked]
+        if len(chosen) == 0:
+            return remaining
+        return np.concatenate(chosen)
+
+    def keep(self, a):
+        """ Boolean mask of the points in a to draw """
+        n = a.shape[0]
+        keep = np.zeros(n, dtype=bool)
+        t = a[self.field_map.get('time', 'time')]
+        order = None
+        if (n > 1) and not np.all(t[1:] >= t[:-1]):
+            order = np.argsort(t, kind='mergesort')
+        for ax in self.panels.ax_specs:
+            keys, (nx, ny) = pixel_bins(self.panels, ax, a, field_map=self.field_map)
+            if order is not None:
+                keys = keys[order]
+            chosen = self._first_in_each_bin(keys, nx*ny)
+            if order is not None:
+                chosen = order[chosen]
+            keep[chosen] = True
+        return keep
+
+    @coroutine
+    def decimate(self):
+        while True:
+            a = (yield)
+            if a.shape[0] > self.min_points:
+                keep = self.keep(a)
+                if not keep.all():
+                    a = a[keep]
+            if self.target is not None:
+                self.target.send(a)
+
+
+class DensityRasterSwitch(object):
+    """ Show the points as 2D rasters sized to the pixel grid of each panel whenever
+        there are at least min_points points, and as the usual scatter plot
+        otherwise. Drawing the rasters takes the same time no matter how many
+        points there are.
+
+        The raster for each panel holds the number of points in each pixel if
+        statistic is 'count', or the 'mean' or 'max' of color_field (by default,
+        the color field of scatter_ctrl) over the points in each pixel. Pixels
+        without points are transparent. Additional
+        kwargs are passed to imshow. When the rasters are shown, recolor draws
+        them again for the current color field of scatter_ctrl.
+    """
+    def __init__(self, panels, scatter_ctrl, target=None, min_points=200000,
+                 statistic='count', color_field=None, field_map=None, **imshow_kwargs):
+        self.panels = panels
+        self.scatter_ctrl = scatter_ctrl
+        self.target = target
+        self.min_points = min_points
+        self.statistic = statistic
+        self.color_field = color_field
+        if field_map is None:
+            field_map = {}
+        self.field_map = field_map
+        self.imshow_kwargs = imshow_kwargs
+        self.images = {}
+        # Data in the rasters, or None if the scatter plot is shown
+        self.raster_data = None
+
+    def raster(self, ax, a):
+        """ Return the raster for ax as a masked array with shape (ny, nx) """
+        keys, (nx, ny) = pixel_bins(self.panels, ax, a, field_map=self.field_map)
+        n_bins = nx*ny
+        counts = np.bincount(keys, minlength=n_bins)
+        color_field = self.color_field
+        if color_field is None:
+            color_field = self.scatter_ctrl.color_field
+        if self.statistic == 'count':
+            values = counts.astype('f8')
+        elif self.statistic == 'mean':
+            sums = np.bincount(keys, weights=a[color_field], minlength=n_bins)
+            values = sums / np.maximum(counts, 1)
+        elif self.statistic == 'max':
+            values = np.empty(n_bins, dtype='f8')
+            values.fill(-np.inf)
+            np.maximum.at(values, keys, a[color_field])
+        else:
+            raise ValueError("Unknown statistic {0}".format(self.statistic))
+        values = np.ma.masked_where(counts == 0, values)
+        return values.reshape(nx, ny).T
+
+    def _set_scatter_visible(self, visible):
+        for outlet in self.scatter_ctrl.artist_outlet_controllers:
+            outlet.artist.set_visible(visible)
+        for image in self.images.values():
+            image.set_visible(not visible)
+
+    def show_rasters(self, a):
+        self.raster_data = a
+        for ax in self.panels.ax_specs:
+            img = self.raster(ax, a)
+            extent = ax.get_xlim() + ax.get_ylim()
+            # Placing the image shouldn't change the view limits, which would set
+            # off another reflow.
+            ax.set_autoscale_on(False)
+            if ax not in self.images:
+                self.images[ax] = ax.imshow(img, extent=extent, origin='lower', aspect='auto',
+                                            interpolation='nearest', **self.imshow_kwargs)
+            else:
+                self.images[ax].set_data(img)
+                self.images[ax].set_extent(extent)
+            if img.count() > 0:
+                self.images[ax].set_clim(img.min(), img.max())
+        self._set_scatter_visible(False)
+
+    def recolor(self):
+        """ Called by scatter_ctrl when its color field changes """
+        if self.raster_data is None:
+            return
+        if (self.statistic != 'count') and (self.color_field is None):
+            self.show_rasters(self.raster_data)
+
+    @coroutine
+    def switch(self):
+        while True:
+            a = (yield)
+            if a.shape[0] >= self.min_points:
+                self.show_rasters(a)
+            else:
+                self.raster_data = None
+                self._set_scatter_visible(True)
+                if self.target is not None:
+                    self.target.send(a)
+
+
+class BlittingFigureUpdater(object):
+    """ Replacement for stormdrain's FigureUpdater that redraws only the data
+        artists when nothing else in the figure has changed.
+
+        The collections and images in each axes (the scatter plots and rasters)
+        are made animated, so that a full draw of the figure leaves them out of
+        the background saved for each axes. As long as the limits of all axes,
+        the size of the figure, and the set of data artists stay the same, an
+        update restores each background, draws the data artists, and blits each
+        axes. Otherwise, or if the canvas can't blit, the whole figure is drawn.
+
+        Animated artists are left out of savefig; call set_blitting(False) before
+        saving.
+    """
+    def __init__(self, figure):
+        self.figure = figure
+        self.blitting = True
+        self.full_draws = 0
+        self.blits = 0
+        self._backgrounds = {}
+        self._signature = None
+        self._draw_cid = figure.canvas.mpl_connect('draw_event', self._on_draw)
+
+    def send(self, msg):
+        self.draw()
+
+    def _data_artists(self, ax):
+        return list(ax.collections) + list(ax.images)
+
+    def signature(self):
+        """ Everything that, when changed, requires a full draw """
+        sig = [tuple(self.figure.canvas.get_width_height()), self.figure.dpi]
+        for ax in self.figure.axes:
+            sig.append((tuple(ax.get_position().bounds), tuple(ax.get_xlim()), tuple(ax.get_ylim()),
+                        tuple(id(art) for art in self._data_artists(ax))))
+        return tuple(sig)
+
+    def set_blitting(self, blitting):
+        self.blitting = blitting
+        for ax in self.figure.axes:
+            for art in self._data_artists(ax):
+                art.set_animated(blitting)
+        self._signature = None
+        self.figure.canvas.draw_idle()
+
+    def _on_draw(self, event):
+        """ After a full draw, keep the background of each axes and draw the
+            data artists on top of it.
+        """
+        if not self.blitting:
+            return
+        canvas = self.figure.canvas
+        self._backgrounds = {}
+        for ax in self.figure.axes:
+            self._backgrounds[ax] = canvas.copy_from_bbox(ax.bbox)
+            for art in self._data_artists(ax):
+                if art.get_animated():
+                    ax.draw_artist(art)
+        self._signature = self.signature()
+
+    def draw(self):
+        canvas = self.figure.canvas
+        if not (self.blitting and getattr(canvas, 'supports_blit', False)):
+            self.full_draws += 1
+            canvas.draw()
+            return
+        for ax in self.figure.axes:
+            for art in self._data_artists(ax):
+                art.set_animated(True)
+        if self.signature() != self._signature:
+            self.full_draws += 1
+            canvas.draw()
+            return
+        self.blits += 1
+        for ax in self.figure.axes:
+            canvas.restore_region(self._backgrounds[ax])
+            for art in self._data_artists(ax):
+                ax.draw_artist(art)
+            canvas.blit(ax.bbox)
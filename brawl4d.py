@@ -2,6 +2,8 @@
     Balloons, Radar, and Aircraft with Lightning = BRAWL.
 
 """
+from __future__ import absolute_import, print_function
+
 import datetime
 import numpy as np
 
@@ -14,10 +16,14 @@ from stormdrain.support.matplotlib.linked import LinkedPanels
 from stormdrain.support.matplotlib.mplevents import MPLaxesManager
 from stormdrain.support.matplotlib.artistupdaters import PanelsScatterController, FigureUpdater
 from stormdrain.support.matplotlib.formatters import SecDayFormatter
-from stormdrain.support.coords.filters import CoordinateSystemController
 
 from stormdrain.support.matplotlib.poly_lasso import PolyLasso
 
+from .filters import TimeWindowFilter
+from .coords import CoordinateSystemController
+from .scheduler import ReflowScheduler
+from .artists import BlittingFigureUpdater
+
 
 def redraw(panels):
     """ this function forces a manual redraw / re-flow of the data to the plot.
@@ -61,6 +67,8 @@ class Panels4D(LinkedPanels):
         self.basedate = kwargs.pop('basedate', None)
         if self.basedate is None:
             self.basedate = datetime.datetime(1970,1,1,0,0,0)
+        reflow_interval = kwargs.pop('reflow_interval', None)
+        background_reflow = kwargs.pop('background_reflow', False)
 
         ctr_lat, ctr_lon, ctr_alt = kwargs.pop('ctr_lat', 33.5), kwargs.pop('ctr_lon', -101.5), kwargs.pop('ctr_alt', 0.0)
         self.cs = CoordinateSystemController(ctr_lat, ctr_lon, ctr_alt)
@@ -98,6 +106,36 @@ class Panels4D(LinkedPanels):
 
         # Note this won't work in <1.2.x: https://github.com/matplotlib/matplotlib/pull/1585/
         resize_id = self.figure.canvas.mpl_connect('resize_event', self._figure_resized)
+        
+        # Coalesce bursts of reflows from panning, zooming and resizing
+        self.reflow_scheduler = None
+        if reflow_interval is not None:
+            self.reflow_scheduler = ReflowScheduler(self.figure, interval=reflow_interval,
+                                                    background=background_reflow)
+    
+    def add_reflow_receiver(self, receiver, exchange='SD_reflow_start'):
+        """ Datasets and figure updaters that should have their reflow messages
+            coalesced by the reflow scheduler are registered here. Does nothing
+            if there is no reflow scheduler.
+        """
+        if self.reflow_scheduler is not None:
+            self.reflow_scheduler.manage(receiver, exchange=exchange)
+    
+    def reflow_checkpoint(self, target):
+        """ Return a pipeline stage that sends to target, unless the reflow has been
+            superseded while running in the background.
+        """
+        if self.reflow_scheduler is None:
+            return target
+        return self.reflow_scheduler.checkpoint(target)
+    
+    def gui_stage(self, target):
+        """ Return a pipeline stage that sends to target in the GUI thread. Put this
+            ahead of anything that updates matplotlib artists.
+        """
+        if self.reflow_scheduler is None:
+            return target
+        return self.reflow_scheduler.gui_stage(target)
     
     def _figure_resized(self, event):
         # Force a reflow of data by notifying the xy axis manager, which needs to
@@ -128,7 +166,7 @@ class Panels4D(LinkedPanels):
             self._active_lasso = PolyLasso(self.figure, self._lasso_callback)
             lock(self._active_lasso)
         else:
-            print "Please deselect other tools to use the lasso."
+            print("Please deselect other tools to use the lasso.")
 
     
 
@@ -163,15 +201,18 @@ def plot_demo_dataset(d, panels):
     # strictly speaking, z in the map projection and MSL alt aren't the same - z is somewhat distorted by the projection.
     # therefore, add some padding. filtered again later after projection.
     transform_mapping = {'z':('alt', (lambda v: (v[0]*1.0e3 - 1.0e3, v[1]*1.0e3 + 1.0e3)) ) }
-    bound_filter = BoundsFilter(target=brancher, bounds=panels.bounds, restrict_to=('time'), transform_mapping=transform_mapping)
+    # The time bounds are found by binary search on a time index built the first time
+    # the data are seen, so that the cost of this step scales with the data in view.
+    bound_filter = TimeWindowFilter(target=brancher, bounds=panels.bounds, transform_mapping=transform_mapping)
     filterer = bound_filter.filter()
     d.target = filterer
+    panels.add_reflow_receiver(d)
     
     # Set up brancher -> coordinate transform -> final_filter -> mutli-axis scatter updater
     scatter_ctrl = PanelsScatterController(panels=panels, color_field='time')
     scatter_outlet_broadcaster = scatter_ctrl.branchpoint
     scatter_updater = scatter_outlet_broadcaster.broadcast() 
-    final_bound_filter = BoundsFilter(target=scatter_updater, bounds=panels.bounds)
+    final_bound_filter = BoundsFilter(target=panels.gui_stage(scatter_updater), bounds=panels.bounds)
     final_filterer = final_bound_filter.filter()
     cs_transformer = panels.cs.project_points(target=final_filterer, x_coord='x', y_coord='y', z_coord='z', 
                         lat_coord='lat', lon_coord='lon', alt_coord='alt', distance_scale_factor=1.0e-3)
@@ -181,7 +222,15 @@ def plot_demo_dataset(d, panels):
     return branch, scatter_outlet_broadcaster
     
 
-def B4D_startup(show=False, basedate=None, ctr_lat=33.5, ctr_lon=-101.5):
+def B4D_startup(show=False, basedate=None, ctr_lat=33.5, ctr_lon=-101.5, reflow_interval=None,
+                background_reflow=False, blit=False):
+    """ If reflow_interval is given, bursts of reflows within that many seconds
+        are coalesced into one. If background_reflow is also True, the filtering
+        and projection happen in a worker thread. See ReflowScheduler.
+        
+        If blit is True, reflows that only change the data redraw just the data
+        artists. See BlittingFigureUpdater.
+    """
     import matplotlib
     fontspec = {'family':'Helvetica', 'weight':'bold', 'size':10}
     matplotlib.rc('font', **fontspec)
@@ -189,8 +238,17 @@ def B4D_startup(show=False, basedate=None, ctr_lat=33.5, ctr_lon=-101.5):
     import matplotlib.pyplot as plt
                         
     panel_fig = plt.figure(figsize=(8.5, 11.0))
-    panels = Panels4D(figure=panel_fig, names_4D=('x', 'y', 'z', 'time'), basedate=basedate, ctr_lat=ctr_lat, ctr_lon=ctr_lon)
-    fig_updater = FigureUpdater(panel_fig)
+    panels = Panels4D(figure=panel_fig, names_4D=('x', 'y', 'z', 'time'), basedate=basedate, ctr_lat=ctr_lat, ctr_lon=ctr_lon,
+                      reflow_interval=reflow_interval, background_reflow=background_reflow)
+    if blit:
+        fig_updater = BlittingFigureUpdater(panel_fig)
+        # Unlike stormdrain's FigureUpdater, it doesn't attach itself, since
+        # LiveLMATimeController draws with one of its own.
+        get_exchange('SD_reflow_done').attach(fig_updater)
+    else:
+        fig_updater = FigureUpdater(panel_fig)
+    panels.figure_updater = fig_updater
+    panels.add_reflow_receiver(fig_updater, exchange='SD_reflow_done')
     
     panels.panels['xy'].axis((-1000, 1000, -1000, 1000))
     panels.panels['tz'].axis((0, 10, 0, 5))
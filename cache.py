@@ -0,0 +1,151 @@
+""" Caching of the results of reflows, so that returning to a view that was
+    seen recently doesn't require running the pipeline again.
+
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+from stormdrain.pipeline import coroutine
+from stormdrain.pubsub import get_exchange
+
+
+def normalized_limits(bounds, digits=9):
+    """ Hashable, sorted representation of the limits of a Bounds object, rounded
+        to digits significant digits so that floating point noise from
+        repeatedly setting the same view doesn't produce a different key.
+    """
+    limits = []
+    for name, (v_min, v_max) in sorted(bounds.limits()):
+        limits.append((name, float('{0:.{1}g}'.format(v_min, digits)),
+                             float('{0:.{1}g}'.format(v_max, digits))))
+    return tuple(limits)
+
+
+class ViewCache(object):
+    """ Least-recently-used cache of the data sent to the scatter artists for
+        each view of a dataset.
+
+        The key is the normalized limits of each of bounds, the dataset's version,
+        and the value of key_extra() if given (e.g., the center of the coordinate
+        system). Entries are dropped, least recently used first, once the cached
+        data exceed max_bytes. The dataset's version attribute must change whenever
+        its data do; datasets without one aren't cached, and data pass straight
+        through lookup().
+
+        Put lookup() directly after the dataset. On a hit, the cached data are sent
+        straight to hit_target, skipping the rest of the pipeline. On a miss, data
+        pass to the target of lookup(), and store() (put just before hit_target)
+        saves what comes out at the end of the pipeline.
+
+        The dataset announces edits on the B4D_dataset_updated exchange with a
+        (dataset, field_names, row_indices) message. Entries containing any edited
+        row are dropped, as are all entries if the edit touches a field used in the
+        key's bounds or the cached data don't have index_name. The rest are kept
+        under the dataset's new version.
+    """
+    def __init__(self, dataset, bounds, hit_target=None, max_bytes=256*2**20,
+                 index_name='hdf_row_idx', key_extra=None):
+        self.dataset = dataset
+        self.bounds = tuple(bounds)
+        self.hit_target = hit_target
+        self.max_bytes = max_bytes
+        self.index_name = index_name
+        self.key_extra = key_extra
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._pending_key = None
+        self.enabled = hasattr(dataset, 'version')
+        get_exchange('B4D_dataset_updated').attach(self)
+
+    def key(self):
+        k = tuple(normalized_limits(b) for b in self.bounds)
+        k += (self.dataset.version,)
+        if self.key_extra is not None:
+            k += (self.key_extra(),)
+        return k
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def _remove(self, key):
+        self.nbytes -= self.entries.pop(key).nbytes
+
+    def put(self, key, a):
+        if key in self.entries:
+            self._remove(key)
+        if a.nbytes > self.max_bytes:
+            return
+        self.entries[key] = a
+        self.nbytes += a.nbytes
+        while self.nbytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def get(self, key):
+        """ Return the cached data for key, or None """
+        a = self.entries.pop(key, None)
+        if a is not None:
+            # Reinsert to mark as most recently used
+            self.entries[key] = a
+        return a
+
+    @coroutine
+    def lookup(self, target):
+        while True:
+            a = (yield)
+            if not self.enabled:
+                target.send(a)
+                continue
+            key = self.key()
+            cached = self.get(key)
+            if cached is not None:
+                self.hits += 1
+                self._pending_key = None
+                if self.hit_target is not None:
+                    self.hit_target.send(cached)
+            else:
+                self.misses += 1
+                self._pending_key = key
+                target.send(a)
+
+    @coroutine
+    def store(self, target):
+        while True:
+            a = (yield)
+            if self._pending_key is not None:
+                self.put(self._pending_key, a)
+                self._pending_key = None
+            target.send(a)
+
+    def send(self, msg):
+        """ B4D_dataset_updated messages are sent here """
+        dataset, field_names, indices = msg
+        if (dataset is not self.dataset) or (not self.enabled):
+            return
+        bounded = set()
+        for b in self.bounds:
+            bounded.update(name for name, limits in b.limits())
+        if (field_names is None) or bounded.intersection(field_names):
+            self.clear()
+            return
+        indices = np.asarray(indices)
+        version = self.dataset.version
+        entries = self.entries
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        for key, a in entries.items():
+            if self.index_name not in a.dtype.names:
+                continue
+            if np.isin(a[self.index_name], indices).any():
+                continue
+            # key is (limits..., version[, extra])
+            n = len(self.bounds)
+            new_key = key[:n] + (version,) + key[n+1:]
+            self.entries[new_key] = a
+            self.nbytes += a.nbytes
@@ -0,0 +1,188 @@
+""" Coordinate system support for the panels.
+
+    The CoordinateSystemController here wraps the one in stormdrain, which does the
+    exact geodetic to local tangent plane transformation, and adds a movable center,
+    a projection cache, and an optional fast tangent plane projection.
+
+"""
+from __future__ import absolute_import
+
+import numpy as np
+from numpy.lib.recfunctions import append_fields
+
+from stormdrain.pipeline import coroutine
+from stormdrain.support.coords.filters import CoordinateSystemController as ExactCoordinateSystemController
+
+from .selection import Selection
+
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1.0/298.257223563
+WGS84_E2 = WGS84_F*(2.0 - WGS84_F)
+
+
+def tangent_plane_coordinates(lon, lat, alt, ctr_lon, ctr_lat, ctr_alt):
+    """ East, north, and up distances in meters of points at lon, lat (degrees) and
+        alt (meters above the WGS84 ellipsoid) from a local tangent plane at ctr_lon,
+        ctr_lat, ctr_alt, computed directly with vectorized float64 operations.
+        
+        Earth-centered coordinates are found in a frame rotated to the center
+        longitude, so that the east distance falls out directly.
+    """
+    lat = np.radians(np.asarray(lat, dtype='f8'))
+    dlon = np.radians(np.asarray(lon, dtype='f8') - ctr_lon)
+    alt = np.asarray(alt, dtype='f8')
+    lat0 = np.radians(ctr_lat)
+    sin_lat0, cos_lat0 = np.sin(lat0), np.cos(lat0)
+    N0 = WGS84_A/np.sqrt(1.0 - WGS84_E2*sin_lat0**2)
+    X0 = (N0 + ctr_alt)*cos_lat0
+    Z0 = (N0*(1.0 - WGS84_E2) + ctr_alt)*sin_lat0
+
+    sin_lat = np.sin(lat)
+    N = WGS84_A/np.sqrt(1.0 - WGS84_E2*sin_lat*sin_lat)
+    r = (N + alt)*np.cos(lat)
+    east = r*np.sin(dlon)
+    dX = r*np.cos(dlon)
+    dX -= X0
+    dZ = (N*(1.0 - WGS84_E2) + alt)*sin_lat
+    dZ -= Z0
+    north = cos_lat0*dZ - sin_lat0*dX
+    up = cos_lat0*dX + sin_lat0*dZ
+    return east, north, up
+
+
+class CoordinateSystemController(object):
+    """ If approximate is True, points are projected with tangent_plane_coordinates
+        instead of the exact stormdrain transformation. Before each projection the
+        fast result is compared to the exact transformation over the extent of the
+        points being projected, and the exact transformation is used instead
+        whenever the difference exceeds tolerance meters. The difference found for
+        the most recent projection is kept in max_error.
+
+        Other attributes, such as geoProj and tanpProj, are those of the stormdrain
+        controller for the current center.
+    """
+    def __init__(self, ctr_lat, ctr_lon, ctr_alt, approximate=False, tolerance=1.0):
+        self.approximate = approximate
+        self.tolerance = tolerance
+        self.max_error = None
+        self.set_center(ctr_lat, ctr_lon, ctr_alt)
+
+    def set_center(self, ctr_lat, ctr_lon, ctr_alt):
+        """ Move the center of the local coordinate system. Any cached projections
+            are recalculated on the next reflow.
+        """
+        self.ctr_lat, self.ctr_lon, self.ctr_alt = ctr_lat, ctr_lon, ctr_alt
+        self._exact = ExactCoordinateSystemController(ctr_lat, ctr_lon, ctr_alt)
+        self._extent_errors = {}
+
+    @property
+    def center(self):
+        return (self.ctr_lat, self.ctr_lon, self.ctr_alt)
+
+    def __getattr__(self, name):
+        # Only called for attributes not found here
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._exact, name)
+
+    def project(self, lon, lat, alt, distance_scale_factor=1.0):
+        """ Return x, y, z arrays for the lon, lat, alt arrays """
+        if self.approximate and (np.size(lon) > 0):
+            self.max_error = self.approximation_error(lon, lat, alt)
+            if self.max_error <= self.tolerance:
+                x, y, z = self._approximate(lon, lat, alt)
+                return (x*distance_scale_factor, y*distance_scale_factor,
+                        z*distance_scale_factor)
+        return self._project_exact(lon, lat, alt, distance_scale_factor)
+
+    def _project_exact(self, lon, lat, alt, distance_scale_factor=1.0):
+        geo = np.empty(np.shape(lon), dtype=[('lon', 'f8'), ('lat', 'f8'), ('alt', 'f8')])
+        geo['lon'], geo['lat'], geo['alt'] = lon, lat, alt
+        projected = []
+        @coroutine
+        def receive():
+            while True:
+                projected.append((yield))
+        projector = self._exact.project_points(target=receive(),
+                            x_coord='x', y_coord='y', z_coord='z',
+                            lat_coord='lat', lon_coord='lon', alt_coord='alt',
+                            distance_scale_factor=distance_scale_factor)
+        projector.send(geo)
+        p = projected[-1]
+        return p['x'], p['y'], p['z']
+
+    def _approximate(self, lon, lat, alt):
+        return tangent_plane_coordinates(lon, lat, alt, self.ctr_lon, self.ctr_lat, self.ctr_alt)
+
+    def approximation_error(self, lon, lat, alt):
+        """ Maximum distance, in meters, between the approximate and exact positions
+            over the longitude, latitude, and altitude extent of the points given.
+            The check is done on a grid spanning the extent, which is rounded
+            outward so that the result can be reused for similar extents.
+        """
+        extent = []
+        for v, step in ((lon, 0.01), (lat, 0.01), (alt, 100.0)):
+            extent.append((np.floor(np.nanmin(v)/step)*step, np.ceil(np.nanmax(v)/step)*step))
+        extent = tuple(extent)
+        if extent not in self._extent_errors:
+            (lon0, lon1), (lat0, lat1), (alt0, alt1) = extent
+            g_lon, g_lat, g_alt = np.meshgrid(np.linspace(lon0, lon1, 9),
+                                              np.linspace(lat0, lat1, 9),
+                                              np.linspace(alt0, alt1, 3), indexing='ij')
+            g_lon, g_lat, g_alt = g_lon.ravel(), g_lat.ravel(), g_alt.ravel()
+            exact = self._project_exact(g_lon, g_lat, g_alt)
+            approx = self._approximate(g_lon, g_lat, g_alt)
+            err = np.sqrt(sum((e - a)**2 for e, a in zip(exact, approx)))
+            self._extent_errors[extent] = err.max()
+        return self._extent_errors[extent]
+
+    @coroutine
+    def project_points(self, target=None, x_coord='x', y_coord='y', z_coord='z',
+                       lat_coord='lat', lon_coord='lon', alt_coord='alt',
+                       distance_scale_factor=1.0):
+        """ Same as project_points in stormdrain's CoordinateSystemController, but
+            follows changes to the center and uses the approximate projection
+            when it is turned on.
+        """
+        kwargs = dict(x_coord=x_coord, y_coord=y_coord, z_coord=z_coord,
+                      lat_coord=lat_coord, lon_coord=lon_coord, alt_coord=alt_coord,
+                      distance_scale_factor=distance_scale_factor)
+        projector, center = None, None
+        while True:
+            a = (yield)
+            if self.approximate:
+                x, y, z = self.project(a[lon_coord], a[lat_coord], a[alt_coord],
+                                       distance_scale_factor=distance_scale_factor)
+                a = append_fields(a, (x_coord, y_coord, z_coord), (x, y, z), usemask=False)
+                if target is not None:
+                    target.send(a)
+                continue
+            if (projector is None) or (center != self.center):
+                center = self.center
+                projector = self._exact.project_points(target=target, **kwargs)
+            projector.send(a)
+
+    @coroutine
+    def cached_projection(self, target=None, x_coord='x', y_coord='y', z_coord='z',
+                          lat_coord='lat', lon_coord='lon', alt_coord='alt',
+                          distance_scale_factor=1.0):
+        """ Project all points in the array received, and send a Selection of the
+            whole array with the projected coordinates as extra columns.
+
+            The projection is kept, and is only recalculated when a different array
+            is received or when the center changes. Put this stage directly after
+            a dataset that sends the same array on every reflow, so that changes in
+            the view cost only a filter downstream, not a coordinate transformation.
+        """
+        projected, center = None, None
+        while True:
+            a = (yield)
+            if (projected is None) or (projected.base is not a) or (center != self.center):
+                center = self.center
+                x, y, z = self.project(a[lon_coord], a[lat_coord], a[alt_coord],
+                                       distance_scale_factor=distance_scale_factor)
+                projected = Selection(a, columns={x_coord:x, y_coord:y, z_coord:z})
+            if target is not None:
+                target.send(projected)
@@ -0,0 +1,203 @@
+""" Pipeline filter stages that complement the generic stormdrain BoundsFilter.
+
+    These stages exploit properties of the data (such as time ordering) so that
+    the cost of a reflow scales with the amount of data in view instead of the
+    amount of data in the dataset.
+
+"""
+from __future__ import absolute_import
+
+import numpy as np
+
+from stormdrain.pipeline import coroutine
+
+from .selection import Selection
+
+
+class TimeIndex(object):
+    """ Time ordering of a named array, built once so that the rows within a time
+        window can be found by bisection.
+
+        If the times are already monotonic, no permutation is stored and windows are
+        returned as slices, which index the data without a copy. Otherwise a stable
+        time-order permutation is kept and windows are returned as arrays of row
+        indices in time order.
+
+        A precomputed permutation may be provided as the time_order attribute of data.
+    """
+    def __init__(self, data, time_name='time'):
+        self.data = data
+        self.time_name = time_name
+        t = data[time_name]
+        order = getattr(data, 'time_order', None)
+        if order is None and (t.shape[0] > 1) and not np.all(t[1:] >= t[:-1]):
+            order = np.argsort(t, kind='mergesort')
+        self.order = order
+        if order is None:
+            self.sorted_times = t
+        else:
+            self.sorted_times = t[order]
+
+    def __len__(self):
+        return self.sorted_times.shape[0]
+
+    def window(self, t_min, t_max):
+        """ Return a slice or index array for rows with t_min <= time <= t_max """
+        i0 = np.searchsorted(self.sorted_times, t_min, side='left')
+        i1 = np.searchsorted(self.sorted_times, t_max, side='right')
+        if self.order is None:
+            return slice(i0, i1)
+        return self.order[i0:i1]
+
+
+class TimeWindowFilter(object):
+    """ Drop-in replacement for BoundsFilter(restrict_to=('time')) that finds the
+        rows in the current time bounds with a binary search.
+
+        The TimeIndex for each array received is built the first time the array is
+        seen and reused while the same array object keeps arriving, which is the
+        case for datasets that send the same data array on every reflow.
+
+        transform_mapping has the same meaning as for BoundsFilter, and is used to
+        find the time field in the data when it isn't called 'time'.
+        
+        If as_selection is True, the window is sent downstream as a Selection
+        that refers back to the received array instead of as a copy of its rows.
+        If a Selection is received and as_selection is False, the rows in the
+        window are gathered into a new array.
+    """
+    def __init__(self, target=None, bounds=None, time_name='time', transform_mapping=None,
+                 as_selection=False):
+        self.target = target
+        self.as_selection = as_selection
+        self.bounds = bounds
+        self.time_name = time_name
+        if transform_mapping is None:
+            transform_mapping = {}
+        self.transform_mapping = transform_mapping
+        self.time_index = None
+
+    def _field_and_limits(self):
+        t_lim = getattr(self.bounds, self.time_name)
+        if self.time_name in self.transform_mapping:
+            field, transform = self.transform_mapping[self.time_name]
+            return field, transform(t_lim)
+        return self.time_name, t_lim
+
+    def index_for(self, a, field):
+        """ Return the TimeIndex for a, building it if a hasn't been seen before """
+        idx = self.time_index
+        if (idx is None) or (idx.data is not a) or (idx.time_name != field):
+            idx = TimeIndex(a, time_name=field)
+            self.time_index = idx
+        return idx
+
+    def invalidate(self):
+        """ Forget the cached TimeIndex. Call after modifying times in place. """
+        self.time_index = None
+
+    def window(self, a):
+        """ Return the subset of a within the current time bounds """
+        field, (t_min, t_max) = self._field_and_limits()
+        try:
+            idx = self.index_for(a, field)
+        except (KeyError, ValueError):
+            # No time field in these data, so pass everything, as BoundsFilter would.
+            return a
+        rows = idx.window(t_min, t_max)
+        if isinstance(a, Selection):
+            if self.as_selection:
+                return a[rows]
+            return a[rows].materialize()
+        if self.as_selection:
+            return Selection(a, index=rows)
+        return a[rows]
+
+    @coroutine
+    def filter(self):
+        while True:
+            a = (yield)
+            if self.target is not None:
+                self.target.send(self.window(a))
+
+
+class FusedBoundsFilter(object):
+    """ Evaluate the criteria of several Bounds objects in a single pass, in
+        place of a chain of BoundsFilters.
+
+        The data are processed in chunks of chunk_size rows. Each chunk is compared
+        against every active criterion using preallocated scratch buffers, so no
+        full-length temporaries are created. The rows that pass all criteria are
+        gathered once at the end.
+
+        bounds is a sequence of Bounds objects. transform_mapping has the same
+        meaning as for BoundsFilter. Criteria on fields that are not in the data,
+        or whose limits are infinite, are skipped. Bounds names in exclude are never
+        evaluated, e.g., because an earlier stage has already applied them.
+    """
+    def __init__(self, target=None, bounds=(), transform_mapping=None, exclude=(),
+                 chunk_size=65536):
+        self.target = target
+        self.bounds = tuple(bounds)
+        if transform_mapping is None:
+            transform_mapping = {}
+        self.transform_mapping = transform_mapping
+        self.exclude = exclude
+        self.chunk_size = chunk_size
+
+    def criteria(self, names):
+        """ Return a list of (field, min, max) for all active criteria that apply
+            to the fields in names.
+        """
+        crit = {}
+        for bounds in self.bounds:
+            for name, limits in bounds.limits():
+                if name in self.exclude:
+                    continue
+                if name in self.transform_mapping:
+                    name, transform = self.transform_mapping[name]
+                    limits = transform(limits)
+                if name not in names:
+                    continue
+                v_min, v_max = limits
+                if np.isneginf(v_min) and np.isposinf(v_max):
+                    continue
+                # When more than one bounds object has a criterion for the same
+                # field, the intersection of the ranges is what survives both.
+                if name in crit:
+                    v_min = max(v_min, crit[name][0])
+                    v_max = min(v_max, crit[name][1])
+                crit[name] = (v_min, v_max)
+        return [(name, v_min, v_max) for name, (v_min, v_max) in crit.items()]
+
+    def mask(self, a):
+        """ Boolean mask of rows in a that satisfy all criteria """
+        n = a.shape[0]
+        good = np.ones(n, dtype=bool)
+        crit = self.criteria(a.dtype.names)
+        if (n == 0) or (len(crit) == 0):
+            return good
+        chunk = self.chunk_size
+        scratch = np.empty(min(n, chunk), dtype=bool)
+        for start in range(0, n, chunk):
+            rows = slice(start, min(start + chunk, n))
+            chunk_good = good[rows]
+            chunk_a = a[rows]
+            tmp = scratch[:chunk_good.shape[0]]
+            for name, v_min, v_max in crit:
+                v = chunk_a[name]
+                np.greater_equal(v, v_min, out=tmp)
+                np.logical_and(chunk_good, tmp, out=chunk_good)
+                np.less_equal(v, v_max, out=tmp)
+                np.logical_and(chunk_good, tmp, out=chunk_good)
+        return good
+
+    @coroutine
+    def filter(self):
+        while True:
+            a = (yield)
+            good = self.mask(a)
+            if not good.all():
+                a = a[good]
+            if self.target is not None:
+                self.target.send(a)
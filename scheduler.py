@@ -0,0 +1,194 @@
+""" Scheduling of reflows of data through the pipelines.
+
+    Interaction with the panels produces bursts of reflow messages: a pan or a
+    window resize changes the limits many times a second, and each change sends
+    SD_bounds_updated, SD_reflow_start, and SD_reflow_done. The ReflowScheduler
+    sits between the exchanges and the receivers (datasets, figure updaters)
+    and turns each burst into one reflow.
+
+    Optionally, the numeric part of the reflow is carried out in a worker thread,
+    so that the GUI (or notebook kernel) stays responsive. NumPy releases the GIL
+    for most of the work done by the filters and projections.
+
+"""
+import threading
+from collections import deque
+
+from matplotlib.backend_bases import TimerBase
+
+from stormdrain.pipeline import coroutine
+from stormdrain.pubsub import get_exchange
+
+
+class _ExchangeInlet(object):
+    """ Attached to an exchange in place of the managed receivers """
+    def __init__(self, scheduler, exchange_name):
+        self.scheduler = scheduler
+        self.exchange_name = exchange_name
+
+    def send(self, msg):
+        self.scheduler.receive(self.exchange_name, msg)
+
+
+class ReflowScheduler(object):
+    """ Collapse all reflow requests that arrive within interval seconds of the first
+        into a single reflow. Because the filters read the bounds when the data
+        arrive, the reflow uses the latest bounds.
+
+        Receivers are handed to the scheduler with manage(), which detaches them
+        from the named exchange. When the reflow is carried out, the latest message
+        from each exchange is sent to its receivers, in the order of exchanges.
+
+        requested and executed count the reflows that were asked for and the
+        reflows that were carried out.
+
+        The figure's canvas provides the timer. If interval is zero, or the canvas
+        has no working timer (as with non-interactive backends), the reflow is
+        carried out right away.
+        
+        If background is True, the receivers of the first exchange are sent their
+        message in a worker thread. Pipelines must then pass their results to the
+        artists through gui_stage, which hands them to the GUI thread, and the
+        receivers of the remaining exchanges (e.g., the figure updater) are sent
+        their messages in the GUI thread once the worker is done. Each new request
+        makes any reflow in progress stale: its results are discarded by gui_stage
+        and it stops at the next checkpoint stage.
+    """
+    def __init__(self, figure, interval=0.05, exchanges=('SD_reflow_start', 'SD_reflow_done'),
+                 background=False, poll_interval=0.02):
+        self.interval = interval
+        self.exchanges = exchanges
+        self.requested = 0
+        self.executed = 0
+        self.generation = 0
+        self._receivers = dict((name, []) for name in exchanges)
+        self._latest = {}
+        self._pending = False
+        self._timer = None
+        if interval > 0:
+            timer = figure.canvas.new_timer(interval=int(1000*interval))
+            # The base class is what non-interactive backends provide, and never fires
+            if type(timer) is not TimerBase:
+                timer.single_shot = True
+                timer.add_callback(self.execute)
+                self._timer = timer
+        self._inlets = [_ExchangeInlet(self, name) for name in exchanges]
+        for inlet in self._inlets:
+            get_exchange(inlet.exchange_name).attach(inlet)
+        
+        self.background = background and (self._timer is not None)
+        self._worker = None
+        if self.background:
+            self._job = None
+            self._job_ready = threading.Condition()
+            self._running_generation = None
+            self._gui_calls = deque()
+            self._poll_timer = figure.canvas.new_timer(interval=int(1000*poll_interval))
+            self._poll_timer.add_callback(self._run_gui_calls)
+            self._poll_timer.start()
+            self._worker = threading.Thread(target=self._work)
+            self._worker.daemon = True
+            self._worker.start()
+
+    def manage(self, receiver, exchange='SD_reflow_start'):
+        """ Route messages for receiver from exchange through the scheduler """
+        get_exchange(exchange).detach(receiver)
+        self._receivers[exchange].append(receiver)
+
+    def release(self, receiver, exchange='SD_reflow_start'):
+        """ Attach receiver directly to the exchange again """
+        self._receivers[exchange].remove(receiver)
+        get_exchange(exchange).attach(receiver)
+
+    def receive(self, exchange_name, msg):
+        if exchange_name == self.exchanges[0]:
+            self.requested += 1
+            self.generation += 1
+        self._latest[exchange_name] = msg
+        if self._timer is None:
+            self.execute()
+        elif not self._pending:
+            self._pending = True
+            self._timer.start()
+
+    def execute(self):
+        """ Carry out the pending reflow now """
+        self._pending = False
+        if self._timer is not None:
+            self._timer.stop()
+        if len(self._latest) == 0:
+            return
+        if self.exchanges[0] in self._latest:
+            self.executed += 1
+        msgs, self._latest = self._latest, {}
+        if self.background:
+            with self._job_ready:
+                if self._job is not None:
+                    # Not started yet, so keep its messages that weren't replaced,
+                    # such as its SD_reflow_start if msgs has only SD_reflow_done
+                    pending = dict(self._job[1])
+                    pending.update(msgs)
+                    msgs = pending
+                self._job = (self.generation, msgs)
+                self._job_ready.notify()
+        else:
+            self._send(self.exchanges, msgs)
+
+    def _send(self, exchanges, msgs):
+        for name in exchanges:
+            if name in msgs:
+                for receiver in self._receivers[name]:
+                    receiver.send(msgs[name])
+
+    def _work(self):
+        """ Worker thread loop: carry out the latest reflow job """
+        while True:
+            with self._job_ready:
+                while self._job is None:
+                    self._job_ready.wait()
+                generation, msgs = self._job
+                self._job = None
+            self._running_generation = generation
+            first = self.exchanges[0]
+            if first in msgs:
+                for receiver in self._receivers[first]:
+                    if self.stale():
+                        break
+                    receiver.send(msgs[first])
+            self._gui_calls.append((generation, self._send, (self.exchanges[1:], msgs)))
+
+    def _run_gui_calls(self):
+        """ Called by the poll timer in the GUI thread """
+        while len(self._gui_calls) > 0:
+            generation, func, args = self._gui_calls.popleft()
+            if generation == self.generation:
+                func(*args)
+
+    def in_worker(self):
+        return threading.current_thread() is self._worker
+
+    def stale(self):
+        """ True if called from a reflow in the worker that has been superseded """
+        return self.in_worker() and (self._running_generation != self.generation)
+
+    @coroutine
+    def checkpoint(self, target):
+        """ Pipeline stage that stops a stale reflow from going any further """
+        while True:
+            a = (yield)
+            if not self.stale():
+                target.send(a)
+
+    @coroutine
+    def gui_stage(self, target):
+        """ Pipeline stage that sends data on to target in the GUI thread, and
+            drops the results of stale reflows.
+        """
+        while True:
+            a = (yield)
+            if self.in_worker():
+                generation = self._running_generation
+                if generation == self.generation:
+                    self._gui_calls.append((generation, target.send, (a,)))
+            else:
+                target.send(a)
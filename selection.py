@@ -0,0 +1,153 @@
+""" Zero-copy subsets of named array data for use in pipelines.
+
+    A Selection is a reference to a base named array plus a row index (a slice or
+    an array of row numbers). It quacks enough like a numpy named array for the
+    stormdrain filters and artist outlets: indexing by field name gathers only
+    that field for the selected rows, and indexing by a boolean mask or index
+    array composes a new index without touching the other fields.
+
+    Columns computed along the way (like projected coordinates) are carried with
+    the selection, already subset to the selected rows.
+
+"""
+import numpy as np
+
+from stormdrain.pipeline import coroutine
+
+
+def _slice_length(sl, n):
+    start, stop, step = sl.indices(n)
+    return max(0, (stop - start + (step - (1 if step > 0 else -1))) // step)
+
+
+class Selection(object):
+    def __init__(self, base, index=None, columns=None):
+        self.base = base
+        if index is None:
+            index = slice(0, base.shape[0])
+        self.index = index
+        if columns is None:
+            columns = {}
+        self.columns = columns
+
+    def __len__(self):
+        if isinstance(self.index, slice):
+            return _slice_length(self.index, self.base.shape[0])
+        return self.index.shape[0]
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    @property
+    def size(self):
+        return len(self)
+
+    @property
+    def dtype(self):
+        base_names = [n for n in self.base.dtype.names if n not in self.columns]
+        descr = [(n, self.base.dtype[n]) for n in base_names]
+        descr += [(n, c.dtype) for n, c in self.columns.items()]
+        return np.dtype(descr)
+
+    @property
+    def nbytes(self):
+        """ Bytes owned by the selection, not counting the shared base array """
+        n = sum(c.nbytes for c in self.columns.values())
+        if not isinstance(self.index, slice):
+            n += self.index.nbytes
+        return n
+
+    def index_array(self):
+        """ Row numbers in the base array of each row in the selection """
+        if isinstance(self.index, slice):
+            return np.arange(*self.index.indices(self.base.shape[0]))
+        return self.index
+
+    def _compose(self, key):
+        if isinstance(self.index, slice) and isinstance(key, slice):
+            start, stop, step = self.index.indices(self.base.shape[0])
+            k0, k1, kstep = key.indices(len(self))
+            if (step == 1) and (kstep == 1):
+                return slice(start + k0, start + max(k0, k1))
+        return self.index_array()[key]
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key in self.columns:
+                return self.columns[key]
+            return self.base[key][self.index]
+        columns = dict((n, c[key]) for n, c in self.columns.items())
+        return Selection(self.base, index=self._compose(key), columns=columns)
+
+    def __setitem__(self, key, value):
+        """ Setting a field stores a new column on this selection; the base
+            array is never modified.
+        """
+        if not isinstance(key, str):
+            raise TypeError("Only fields of a Selection may be assigned")
+        if key in self.base.dtype.names:
+            dtype = self.base.dtype[key]
+        else:
+            dtype = np.asarray(value).dtype
+        column = np.empty(len(self), dtype=dtype)
+        column[:] = value
+        self.columns[key] = column
+
+    def with_columns(self, **columns):
+        """ Return a new selection of the same rows with additional columns """
+        all_columns = dict(self.columns)
+        all_columns.update(columns)
+        return Selection(self.base, index=self.index, columns=all_columns)
+
+    def materialize(self, names=None):
+        """ Gather the selected rows into a new named array with the fields in
+            names, or all fields if names is None.
+        """
+        dtype = self.dtype
+        if names is not None:
+            dtype = np.dtype([(n, dtype[n]) for n in names])
+        a = np.empty(len(self), dtype=dtype)
+        for name in dtype.names:
+            a[name] = self[name]
+        return a
+
+
+def as_selection(a):
+    """ Wrap a in a Selection of all its rows, unless it is a Selection already """
+    if isinstance(a, Selection):
+        return a
+    return Selection(a)
+
+
+class _LastMessage(object):
+    def __init__(self):
+        self.message = None
+
+    @coroutine
+    def receive(self):
+        while True:
+            self.message = (yield)
+
+
+@coroutine
+def project_selection(cs, target=None, x_coord='x', y_coord='y', z_coord='z',
+                      lat_coord='lat', lon_coord='lon', alt_coord='alt',
+                      distance_scale_factor=1.0):
+    """ Equivalent of cs.project_points for Selections. Only the three coordinate
+        fields of the selected rows are gathered and sent through the projection;
+        the projected coordinates are attached to the selection as new columns.
+    """
+    projected = _LastMessage()
+    projector = cs.project_points(target=projected.receive(),
+                        x_coord=x_coord, y_coord=y_coord, z_coord=z_coord,
+                        lat_coord=lat_coord, lon_coord=lon_coord, alt_coord=alt_coord,
+                        distance_scale_factor=distance_scale_factor)
+    while True:
+        sel = as_selection((yield))
+        geo = sel.materialize(names=(lon_coord, lat_coord, alt_coord))
+        projector.send(geo)
+        p = projected.message
+        columns = {x_coord: p[x_coord], y_coord: p[y_coord], z_coord: p[z_coord]}
+        if target is not None:
+            target.send(sel.with_columns(**columns))